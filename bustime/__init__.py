@@ -1,29 +1,130 @@
 """This is a simple wrapper object around the BusTime API."""
 
-import urllib.request as request
 import json
-import dateutil
-import dateutil.parser
+from operator import itemgetter
 from .distance import Distance
 from .stops import Stops
-import unittest
+from .models import Stop, Prediction, Vehicle, Pattern, PatternPoint
+from .timeparse import parse_time
+from .metrics import NULL_METRICS
+from . import jsonstream
 
 BASE = "http://realtime.portauthority.org/bustime/api/v2/{method}?key={key}&format={format}"
 
 class BustimeError(Exception): pass
 class BustimeParameterError(BustimeError): pass
 
-_request_factory = lambda: request
+def _request_factory():
+    #imported here, since urllib.request is slow to import and isn't
+    #needed at all with another transport
+    import urllib.request
+    return urllib.request
 
+#parameters BusTime names the id with, in an error about one id
+ID_FIELDS = ("stpid", "vid", "rt", "pid")
 
-class BusTime:
-    """Wrapper around the BusTime API service. Handles all of the communication,
-    parsing of JSON, and extracting key data from
-    BusTime API responses."""
-    def __init__(self, apibase, key, *, factory=_request_factory):
+def _error_id(error):
+    for field in ID_FIELDS:
+        if field in error:
+            return str(error[field])
+    return None
+
+def _unpack(data, partial=False):
+    """Decode a raw response body, raising BustimeError if it's an error.
+    If partial, errors about a single id are left in resp["error"] for the
+    caller, and only other errors raise."""
+    jd = json.loads(data.decode("UTF8"))
+    resp = jd["bustime-response"]
+    if "error" in resp.keys():
+        errors = [e for e in resp["error"] if not partial or _error_id(e) is None]
+        if errors:
+            raise BustimeError(errors[0]["msg"])
+    return resp
+
+def split_batch(resp, key, field, ids):
+    """Split a response for several ids into (found, errors): found maps each
+    of ids that BusTime answered for to its records from resp[key] (matched
+    on field), and errors maps each id it reported an error for to the
+    error message."""
+    errors = dict()
+    for e in resp.get("error", ()):
+        errors[_error_id(e)] = e["msg"]
+    found = dict((i, []) for i in ids if i not in errors)
+    for r in resp.get(key, ()):
+        records = found.get(str(r[field]))
+        if records is not None:
+            records.append(r)
+    return found, errors
+
+def _patternparams(patterns, routes):
+    if patterns and routes:
+        raise BustimeParameterError("Supply pattern ids or route names, but not both.")
+    if not patterns and not routes:
+        raise BustimeParameterError("Pattern ids or routes are required")
+    kwargs = dict()
+    if patterns:
+        kwargs["pid"] = ",".join([str(p) for p in patterns])
+    if routes:
+        kwargs["rt"] = ",".join(routes)
+    return kwargs
+
+def _streamed(request, metrics, method, url, parse, convert=None):
+    """Yield the items parse finds in the response to url, converted if
+    convert is given. The request is only made once the first item is asked
+    for, so an iterator that's never started holds no connection; the
+    response is closed, and the call finished, when it's exhausted or
+    closed."""
+    call = metrics.start("bustime", method)
+    error = None
+    try:
+        resp = request.urlopen(url)
+        call.mark("connect")
+        try:
+            for item in parse(_Counted(resp, call)):
+                yield item if convert is None else convert(item)
+        finally:
+            resp.close()
+            call.mark("stream")
+    except Exception as e:
+        error = e
+        raise
+    finally:
+        metrics.finish(call, error)
+
+class _Counted:
+    """Wraps a response, adding the bytes read from it to call.bytes."""
+    def __init__(self, resp, call):
+        self.resp = resp
+        self.call = call
+
+    def read(self, amt=None):
+        data = self.resp.read(amt)
+        self.call.bytes += len(data)
+        return data
+
+def _directions(resp):
+    return [d["dir"] for d in resp["directions"]]
+
+
+class _BusTimeClient:
+    """Everything BusTime and aio.AsyncBusTime share: URL building,
+    parameter checks and the API methods, all of which go through _call."""
+    def __init__(self, apibase, key, *, factory=_request_factory, cache=None,
+            typed=False, tz=None, metrics=None):
+        """cache is an optional ResponseCache for the static endpoints.
+        If typed is set, stops, predictions, vehicles and patterns are
+        returned as the record types in bustime.models instead of dicts.
+        tz is the agency's timezone (a tzinfo or zone name), used to make
+        gettime, and the timestamps of typed records, aware datetimes.
+        metrics is an optional bustime.metrics.Metrics, to time every call.
+        Without one, calls go to metrics.NULL_METRICS."""
         self.key = key
         self.apibase = apibase
         self.request = factory()
+        self.cache = cache
+        self.typed = typed
+        self.tz = tz
+        self.metrics = NULL_METRICS if metrics is None else metrics
 
     def buildurl(self, method, **kwargs):
         """Generate the URL for the restful methods."""
@@ -32,28 +133,69 @@ class BusTime:
             url += "&{0}={1}".format(k, v)
         return url
 
-    def __callrest(self, method, **kwargs):
-        """Invoke a RESTful method.
-        Params passed as kwargs are converted to URL parameters"""
-        url = self.buildurl(method, **kwargs)
-        data = self.request.urlopen(url).read()
-        jd = json.loads(data.decode("UTF8"))
-        resp = jd["bustime-response"]
-        if "error" in resp.keys():
-            raise BustimeError(resp["error"][0]["msg"])
+    def _call(self, method, extract, partial=False, **kwargs):
+        """Invoke a RESTful method and pull the result out of the response
+        with extract. partial is passed on to _unpack.
+        AsyncBusTime overrides this with a coroutine."""
+        with self.metrics.call("bustime", method) as call:
+            resp = self._cached(method, call, kwargs)
+            if resp is None:
+                r = self.request.urlopen(self.buildurl(method, **kwargs))
+                resp = self._receive(method, call, partial, kwargs, r)
+            result = extract(resp)
+            call.mark("extract")
+            return result
+
+    def _records(self, key, model):
+        """Extract function for a list of records, typed or not."""
+        if self.typed:
+            model = model.in_timezone(self.tz)
+            return lambda resp: model.from_dicts(resp[key])
+        return itemgetter(key)
+
+    def _cachefor(self, method):
+        """The cache to use for method, if it's cacheable."""
+        cache = self.cache
+        if cache is not None and method in cache.ttls:
+            return cache
+        return None
+
+    def _cached(self, method, call, kwargs):
+        """The cached response for a call, if there is one."""
+        cache = self._cachefor(method)
+        if cache is None:
+            return None
+        resp = cache.get(method, kwargs, self.apibase)
+        if resp is not None:
+            call.cached = True
+            call.mark("cache")
+        return resp
+
+    def _receive(self, method, call, partial, kwargs, r):
+        """Read and decode the response r returned by urlopen, and cache
+        it if the method is cacheable. Phases are marked in call."""
+        call.mark("connect")
+        try:
+            data = r.read()
+        finally:
+            r.close()
+        call.mark("transfer")
+        call.bytes = len(data)
+        resp = _unpack(data, partial)
+        call.mark("decode")
+        cache = self._cachefor(method)
+        if cache is not None and "error" not in resp:
+            cache.put(method, kwargs, data, resp, self.apibase)
         return resp
 
     def gettime(self):
         """Get the bustime server's system time. Returns a datetime object."""
-        resp = self.__callrest("gettime")
-        dt = resp["tm"]
-        return dateutil.parser.parse(dt)
+        return self._call("gettime", lambda resp: parse_time(resp["tm"], self.tz))
 
     def getdirections(self, route):
         """List the directions for a route.
         In Pittsburgh, this is always ["OUTBOUND","INBOUND"]"""
-        resp = self.__callrest("getdirections", rt=route)
-        return [d["dir"] for d in resp["directions"]]
+        return self._call("getdirections", _directions, rt=route)
 
     def getstops(self, route, direction):
         """List the stops for a route, going in a certain direction.
@@ -61,18 +203,16 @@ class BusTime:
             a dictionary like:
         {'stpid': '2564', 'stpnm': '5th Ave  at Meyran Ave',
         'lon': -79.959239533731, 'lat': 40.441172012068}"""
-        resp = self.__callrest("getstops", rt=route, dir=direction)
-        return resp["stops"]
+        return self._call("getstops", self._records("stops", Stop), rt=route, dir=direction)
 
     def getpredictions(self, stopid, routes=None, top=10):
         """Return predictions for a stop."""
         if routes:
             rt = ",".join(routes)
-            resp = self.__callrest("getpredictions", stpid=stopid,
-                    top=top, rt=rt)
-        else:
-            resp = self.__callrest("getpredictions", stpid=stopid, top=top)
-        return resp["prd"]
+            return self._call("getpredictions", self._records("prd", Prediction),
+                    stpid=stopid, top=top, rt=rt)
+        return self._call("getpredictions", self._records("prd", Prediction),
+                stpid=stopid, top=top)
 
     def getvehicles(self, vehicles=None, routes=None, resolution="S"):
         """Returns vehicles, either selected by ID or by route numbers.
@@ -87,29 +227,38 @@ class BusTime:
         if routes:
             kwargs["rt"] = ",".join(routes)
         kwargs["resolution"] = resolution
-        resp = self.__callrest("getvehicles", **kwargs)
-        return resp["vehicle"]
+        return self._call("getvehicles", self._records("vehicle", Vehicle), **kwargs)
+
+    def getbatch(self, method, key, field, ids, model=None, **kwargs):
+        """Call method for several ids at once (at most ten), passed
+        comma-joined as the field parameter, and split the result by id.
+        BusTime answers for the ids it can and adds an error entry for each
+        one it can't, so one bad id doesn't fail the others.
+        Returns (found, errors), as split_batch does; if the client is
+        typed, found holds model records. An error that isn't about one
+        of the ids (like a transaction limit) raises BustimeError."""
+        ids = [str(i) for i in ids]
+        kwargs[field] = ",".join(ids)
+        convert = None
+        if self.typed and model is not None:
+            convert = model.in_timezone(self.tz).from_dicts
+        def extract(resp):
+            found, errors = split_batch(resp, key, field, ids)
+            if convert is not None:
+                found = dict((i, convert(rs)) for (i, rs) in found.items())
+            return found, errors
+        return self._call(method, extract, True, **kwargs)
 
     def getroutes(self, feed=None):
         """Lists the routes in the system. The dictionary is like:
         {'rt': '12', 'rtnm': 'MCKNIGHT', 'rtclr': '#cc00cc'}"""
         if feed:
-            resp = self.__callrest("getroutes", rtpidatafeed=feed)
-        else:
-            resp = self.__callrest("getroutes")
-        return resp["routes"]
+            return self._call("getroutes", itemgetter("routes"), rtpidatafeed=feed)
+        return self._call("getroutes", itemgetter("routes"))
 
     def getpatterns(self, patterns=None, routes=None):
-        if patterns and routes:
-            raise BustimeParameterError("Supply pattern ids or route names, but not both.")
-        if not patterns and not routes:
-            raise BustimeParameterError("Pattern ids or routes are required")
-        kwargs = dict()
-        if patterns:
-            kwargs["pid"] = ",".join([str(p) for p in patterns])
-        if routes:
-            kwargs["rt"] = ",".join(routes)
-        return self.__callrest("getpatterns", **kwargs)["ptr"]
+        kwargs = _patternparams(patterns, routes)
+        return self._call("getpatterns", self._records("ptr", Pattern), **kwargs)
 
     def getservicebulletins(self, **kwargs):
         params = dict()
@@ -121,7 +270,35 @@ class BusTime:
             params["stpid"] = ",".join(kwargs["stops"])
         if "direction" in kwargs:
             params["rtdir"] = kwargs["direction"]
-        return self.__callrest("getservicebulletins", **params)["sb"]
+        return self._call("getservicebulletins", itemgetter("sb"), **params)
 
     def getrtpidatafeeds(self):
-        return self.__callrest("getrtpidatafeeds")["rtpidatafeeds"]
+        return self._call("getrtpidatafeeds", itemgetter("rtpidatafeeds"))
+
+
+class BusTime(_BusTimeClient):
+    """Wrapper around the BusTime API service. Handles all of the communication,
+    parsing of JSON, and extracting key data from
+    BusTime API responses."""
+    def __streamrest(self, method, kwargs, parse, convert=None):
+        """Stream the items parse yields from a RESTful method's response.
+        The call is made when iteration starts. Bypasses the cache."""
+        return _streamed(self.request, self.metrics, method,
+            self.buildurl(method, **kwargs), parse, convert)
+
+    def iterpatterns(self, patterns=None, routes=None):
+        """Stream getpatterns: parses the response as it arrives, yielding
+        (pattern, point) pairs instead of building every pattern in memory.
+        pattern is a dict of the pattern's fields other than "pt" that
+        came before its points (in practice, pid, ln and rtdir)."""
+        convert = None
+        if self.typed:
+            convert = lambda pp: (pp[0], PatternPoint.from_dict(pp[1]))
+        return self.__streamrest("getpatterns", _patternparams(patterns, routes),
+            jsonstream.pattern_points, convert)
+
+    def iterstops(self, route, direction):
+        """Stream getstops, yielding stops as they're parsed."""
+        convert = Stop.from_dict if self.typed else None
+        return self.__streamrest("getstops", {"rt": route, "dir": direction},
+            lambda resp: jsonstream.records(resp, "stops"), convert)
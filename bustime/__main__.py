@@ -1,8 +1,44 @@
 import unittest
-import dateutil
-import dateutil.parser
-from . import BusTime, BASE, BustimeParameterError
-from .requestmock import MockRequest
+import asyncio
+import json
+import os
+import time
+import tracemalloc
+from io import BytesIO
+import tempfile
+import threading
+try:
+    import dateutil.parser
+except ImportError:
+    dateutil = None
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from . import BusTime, BASE, BustimeError, BustimeParameterError
+from .requestmock import MockRequest, AsyncMockRequest, SyntheticRequest
+from .aio import AsyncBusTime, AsyncRequest, AsyncStops
+from . import aio
+from .batching import Batcher
+from .vehicles import VehicleTracker, stream_vehicles
+from .models import Stop, Prediction, Vehicle, Pattern, PatternPoint, PatternPoints
+from .timeparse import parse_time
+from . import jsonstream
+from .bench import synthetic_points
+from . import bench
+import contextlib
+import io
+from .eta import ETAEngine, Positions
+from .metrics import Metrics, Registry, Histogram, NULL_METRICS
+from .snapshot import SnapshotBuilder, Snapshot, write_snapshot
+import functools
+import gc
+from datetime import datetime
+from zoneinfo import ZoneInfo
+from .transport import PooledRequest
+from .cache import ResponseCache, SqliteStore
+from . import distance
+from .distance import Distance, GreatCircleDistance, haversine
+from .stops import Stops
+from .stopindex import StopIndex
+from .bench import synthetic_stops
 
 class URLTest(unittest.TestCase):
     def setUp(self):
@@ -24,7 +60,7 @@ class MockedTest(unittest.TestCase):
 
     def test_time(self):
         time = self.bustime.gettime()
-        self.assertEqual(time, dateutil.parser.parse("20141012 10:21:04"))
+        self.assertEqual(time, datetime(2014, 10, 12, 10, 21, 4))
 
     def test_directions(self):
         dirs = self.bustime.getdirections("71C")
@@ -52,6 +88,1066 @@ class MockedTest(unittest.TestCase):
         self.assertRaises(BustimeParameterError, self.bustime.getpatterns)
         self.assertRaises(BustimeParameterError, self.bustime.getpatterns, [1], [2])
 
+class ErrorRequest(MockRequest):
+    def getpredictions(self, **kwargs):
+        return json.dumps({"bustime-response":
+            {"error": [{"msg": "No data found for parameter"}]}})
+
+class _MockHandler(BaseHTTPRequestHandler):
+    protocol_version = "HTTP/1.1"
+    mock = MockRequest()
+
+    def do_GET(self):
+        body = self.mock.urlopen(self.path).read()
+        self.send_response(200)
+        self.send_header("Content-Type", "application/json")
+        self.send_header("Content-Length", str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def log_message(self, *args):
+        pass
+
+class PooledTest(unittest.TestCase):
+    def test_keepalive(self):
+        server = ThreadingHTTPServer(("127.0.0.1", 0), _MockHandler)
+        thread = threading.Thread(target=server.serve_forever, daemon=True)
+        thread.start()
+        try:
+            base = "http://127.0.0.1:{0}/bustime/api/v2/".format(server.server_port)
+            pool = PooledRequest()
+            bustime = BusTime(base + "{method}?key={key}&format={format}",
+                "NOKEY", factory=lambda: pool)
+            for i in range(20):
+                self.assertEqual(len(bustime.getdirections("71C")), 2)
+            self.assertEqual(pool.connections_opened, 1)
+            pool.close()
+        finally:
+            server.shutdown()
+            server.server_close()
+
+    def test_stale_retry(self):
+        mock = MockRequest()
+        pool = PooledRequest(connection_factory=mock.connection)
+        bustime = BusTime(BASE, "NOKEY", factory=lambda: pool)
+        bustime.gettime()
+        conn, _ = pool._idle[("http", "realtime.portauthority.org", None)][0]
+        conn.stale = True
+        self.assertEqual(bustime.getstops("71C", "INBOUND")[0]["stpid"], '2564')
+        self.assertEqual(pool.connections_opened, 2)
+
+    def test_failed_read(self):
+        mock = MockRequest()
+        def connect(*args):
+            conn = mock.connection(*args)
+            getresponse = conn.getresponse
+            def broken():
+                resp = getresponse()
+                def read(amt=None):
+                    raise TimeoutError("read timed out")
+                resp.read = read
+                return resp
+            conn.getresponse = broken
+            return conn
+        pool = PooledRequest(pool_size=2, connection_factory=connect, acquire_timeout=1)
+        bustime = BusTime(BASE, "NOKEY", factory=lambda: pool)
+        for i in range(3):
+            self.assertRaises(TimeoutError, bustime.gettime)
+        self.assertEqual(pool.connections_opened, 3)
+        self.assertEqual(pool._idle.get(("http", "realtime.portauthority.org", None), []), [])
+
+    def test_acquire_timeout(self):
+        mock = MockRequest()
+        pool = PooledRequest(pool_size=1, connection_factory=mock.connection,
+            acquire_timeout=0.05)
+        url = BusTime(BASE, "NOKEY").buildurl("gettime")
+        held = pool.urlopen(url)
+        self.assertRaises(TimeoutError, pool.urlopen, url)
+        held.read()
+        pool.urlopen(url).read()
+
+class CountingRequest(MockRequest):
+    def __init__(self):
+        self.calls = 0
+
+    def urlopen(self, url):
+        self.calls += 1
+        return super().urlopen(url)
+
+class CacheTest(unittest.TestCase):
+    def setUp(self):
+        self.now = 1000.0
+        self.mock = CountingRequest()
+
+    def client(self, cache):
+        return BusTime(BASE, "NOKEY", factory=lambda: self.mock, cache=cache)
+
+    def test_hits(self):
+        cache = ResponseCache(clock=lambda: self.now)
+        bustime = self.client(cache)
+        for i in range(5):
+            bustime.getstops("71C", "INBOUND")
+        bustime.getstops("71C", "OUTBOUND")
+        bustime.gettime()
+        bustime.gettime()
+        self.assertEqual(self.mock.calls, 4)
+        self.assertEqual((cache.hits, cache.misses), (4, 2))
+
+    def test_expiry(self):
+        cache = ResponseCache({"getroutes": 60}, clock=lambda: self.now)
+        bustime = self.client(cache)
+        bustime.getroutes()
+        self.now += 30
+        bustime.getroutes()
+        self.assertEqual(self.mock.calls, 1)
+        self.now += 31
+        bustime.getroutes()
+        self.assertEqual(self.mock.calls, 2)
+
+    def test_eviction(self):
+        cache = ResponseCache(clock=lambda: self.now)
+        bustime = self.client(cache)
+        bustime.getdirections("1")
+        cache.max_bytes = cache.size * 2
+        bustime.getdirections("2")
+        bustime.getdirections("1")
+        bustime.getdirections("3")
+        self.assertEqual(len(cache), 2)
+        bustime.getdirections("1")
+        self.assertEqual(self.mock.calls, 3)
+        bustime.getdirections("2")
+        self.assertEqual(self.mock.calls, 4)
+
+    def test_store(self):
+        fd, path = tempfile.mkstemp(suffix=".sqlite")
+        os.close(fd)
+        try:
+            store = SqliteStore(path)
+            self.client(ResponseCache(store=store, clock=lambda: self.now)).getroutes()
+            store.close()
+            store = SqliteStore(path)
+            cache = ResponseCache(store=store, clock=lambda: self.now)
+            routes = self.client(cache).getroutes()
+            store.close()
+            self.assertEqual(routes[0]["rt"], "12")
+            self.assertEqual(self.mock.calls, 1)
+            self.assertEqual(cache.hits, 1)
+        finally:
+            os.remove(path)
+
+    def test_shared(self):
+        cache = ResponseCache(clock=lambda: self.now)
+        self.client(cache).getroutes()
+        other = SyntheticRequest(routes=3)
+        routes = BusTime("http://other.example/bustime/api/v2/{method}?key={key}&format={format}",
+            "NOKEY", factory=lambda: other, cache=cache).getroutes()
+        self.assertEqual([r["rt"] for r in routes], ["1", "2", "3"])
+        self.assertEqual(other.calls, 1)
+        self.client(cache).getroutes()
+        self.assertEqual(self.mock.calls, 1)
+        #the API key isn't part of the cache key
+        BusTime(BASE, "OTHERKEY", factory=lambda: self.mock, cache=cache).getroutes()
+        self.assertEqual(self.mock.calls, 1)
+
+class GreatCircleTest(unittest.TestCase):
+    origin = {"lat": 40.441172012068, "lon": -79.959239533731}
+    points = [{"lat": 41.441172012068, "lon": -79.959239533731},
+        {"lat": 40.441172012068, "lon": -79.958},
+        {"lat": "40.46042251586914", "lon": "-79.92157814719461"}]
+
+    def check(self, formula):
+        dist = GreatCircleDistance(formula=formula)
+        result = dist.distance_points(self.origin, *self.points)
+        self.assertEqual(len(result), 3)
+        self.assertAlmostEqual(result[0][0]["value"], 111195, delta=1)
+        self.assertEqual(result[1][0]["value"], 105)
+        self.assertEqual(result[1][1]["value"], 75)
+        self.assertIs(result[2][2], self.points[2])
+        expected = haversine(self.origin["lat"], self.origin["lon"],
+            self.points[2]["lat"], self.points[2]["lon"])
+        self.assertAlmostEqual(result[2][0]["value"], expected, delta=1)
+
+    def test_formulas(self):
+        self.check("haversine")
+        self.check("equirectangular")
+
+    def test_fallback(self):
+        saved, distance._numpy = distance._numpy, None
+        try:
+            self.check("haversine")
+            self.check("equirectangular")
+        finally:
+            distance._numpy = saved
+
+    def test_stops_in_range(self):
+        stops = Stops(BusTime(BASE, "NOKEY", factory=MockRequest),
+            GreatCircleDistance())
+        near = stops.stops_in_range("71C", "INBOUND", self.origin)
+        self.assertEqual([s["stpid"] for s in near], ["2564"])
+        far = {"lat": 40.46, "lon": -79.92}
+        self.assertEqual(stops.stops_in_range("71C", "INBOUND", far), [])
+        self.assertEqual(len(stops.stops_in_range("71C", "INBOUND", far,
+            duration=60 * 60)), 1)
+
+class RoutesRequest(CountingRequest):
+    def __init__(self, routes):
+        super().__init__()
+        self.routes = routes
+
+    def getroutes(self, **kwargs):
+        return json.dumps({"bustime-response":
+            {"routes": [{"rt": r} for r in self.routes]}})
+
+class StopIndexTest(unittest.TestCase):
+    def test_from_api(self):
+        index = StopIndex.from_api(BusTime(BASE, "NOKEY", factory=MockRequest))
+        self.assertEqual(len(index), 1)
+        found = index.within(GreatCircleTest.origin, 50)
+        self.assertEqual(found[0][1]["stpid"], "2564")
+        self.assertEqual(found[0][2], {("12", "INBOUND"), ("12", "OUTBOUND")})
+
+    def test_refresh(self):
+        mock = RoutesRequest(["1", "2"])
+        bustime = BusTime(BASE, "NOKEY", factory=lambda: mock)
+        index = StopIndex.from_api(bustime)
+        calls = mock.calls
+        mock.routes = ["2", "3"]
+        index.refresh(bustime)
+        self.assertEqual(mock.calls - calls, 4)
+        self.assertEqual(set(index.routes), {"2", "3"})
+        self.assertTrue(all(r != "1" for r, d in index.members["2564"]))
+        mock.routes = []
+        index.refresh(bustime)
+        self.assertEqual(len(index), 0)
+
+    def test_queries(self):
+        stops = synthetic_stops(2000)
+        index = StopIndex()
+        index.add_stops("1", "INBOUND", stops[:1200])
+        index.add_stops("2", "OUTBOUND", stops[1000:])
+        self.assertEqual(len(index), 2000)
+        where = {"lat": 40.44, "lon": -80.0}
+        expected = sorted(s["stpid"] for s in stops
+            if haversine(where["lat"], where["lon"], s["lat"], s["lon"]) <= 1500)
+        found = index.within(where, 1500)
+        self.assertTrue(expected)
+        self.assertEqual(sorted(f[1]["stpid"] for f in found), expected)
+        self.assertEqual([f[0] for f in found], sorted(f[0] for f in found))
+        nearest = index.nearest(where, 3)
+        self.assertEqual(nearest, found[:3])
+
+class SystemRequest(MockRequest):
+    """Serves stops stops (50 by default), each with one prediction, slowly."""
+    def __init__(self, delay=0.05, stops=50):
+        self.delay = delay
+        self.stops = stops
+        self.lock = threading.Lock()
+        self.active = 0
+        self.peak = 0
+
+    def getstops(self, **kwargs):
+        stops = [{"stpid": str(i), "stpnm": "Stop {0}".format(i),
+            "lat": 40.44, "lon": -79.96} for i in range(self.stops)]
+        return json.dumps({"bustime-response": {"stops": stops}})
+
+    def getpredictions(self, **kwargs):
+        with self.lock:
+            self.active += 1
+            self.peak = max(self.peak, self.active)
+        time.sleep(self.delay)
+        with self.lock:
+            self.active -= 1
+        prd = [{"stpid": s, "rt": "71C", "prdctdn": "DUE",
+            "prdtm": "20141022 12:{0:02d}".format(59 - int(s))}
+            for s in kwargs["stpid"][0].split(",")]
+        return json.dumps({"bustime-response": {"prd": prd}})
+
+class NextBussesTest(unittest.TestCase):
+    def test_concurrent(self):
+        mock = SystemRequest()
+        stops = Stops(BusTime(BASE, "NOKEY", factory=lambda: mock),
+            GreatCircleDistance(), max_workers=5)
+        start = time.perf_counter()
+        prd = stops.next_busses("71C", "INBOUND", GreatCircleTest.origin, 2000)
+        elapsed = time.perf_counter() - start
+        stops.close()
+        self.assertEqual(len(prd), 50)
+        self.assertEqual([p["stpid"] for p in prd], [str(i) for i in range(49, -1, -1)])
+        #how many batches overlap, and how long they take, depends on load
+        self.assertTrue(1 < mock.peak <= 5)
+        self.assertLess(elapsed, 10 * mock.delay)
+
+    def test_timeout(self):
+        mock = CountingSystemRequest(delay=0.2)
+        stops = Stops(BusTime(BASE, "NOKEY", factory=lambda: mock),
+            GreatCircleDistance(), max_workers=2, timeout=0.01)
+        self.assertRaises(TimeoutError, stops.next_busses, "71C", "INBOUND",
+            GreatCircleTest.origin, 2000)
+        time.sleep(0.5)
+        stops.close()
+        #getstops, and the two batches that had started
+        self.assertEqual(mock.calls, 3)
+
+    def test_timeout_serial(self):
+        #one batch, and one worker, are held to the timeout too
+        for (workers, count) in [(4, 5), (1, 50)]:
+            mock = CountingSystemRequest(delay=0.2, stops=count)
+            stops = Stops(BusTime(BASE, "NOKEY", factory=lambda: mock),
+                GreatCircleDistance(), max_workers=workers, timeout=0.01)
+            start = time.perf_counter()
+            self.assertRaises(TimeoutError, stops.next_busses, "71C", "INBOUND",
+                GreatCircleTest.origin, 2000)
+            self.assertLess(time.perf_counter() - start, 0.2)
+            time.sleep(0.3)
+            stops.close()
+            #getstops, and the one batch that had started
+            self.assertEqual(mock.calls, 2)
+
+class AsyncSystemRequest(SystemRequest):
+    def __init__(self, latency=0.05):
+        super().__init__(delay=0)
+        self.latency = latency
+
+    async def urlopen(self, url):
+        await asyncio.sleep(self.latency)
+        return MockRequest.urlopen(self, url)
+
+class AsyncCountingRequest(AsyncSystemRequest):
+    def __init__(self, latency=0.05):
+        super().__init__(latency)
+        self.calls = 0
+
+    async def urlopen(self, url):
+        self.calls += 1
+        return await super().urlopen(url)
+
+class AsyncErrorRequest(AsyncMockRequest):
+    getpredictions = ErrorRequest.getpredictions
+
+class AsyncTest(unittest.TestCase):
+    def setUp(self):
+        self.bustime = AsyncBusTime(BASE, "NOKEY", factory=AsyncMockRequest)
+
+    def run_async(self, coro):
+        return asyncio.run(coro)
+
+    def test_methods(self):
+        async def calls():
+            b = self.bustime
+            return await asyncio.gather(b.gettime(), b.getdirections("71C"),
+                b.getstops("71C", "INBOUND"), b.getpredictions("2564", ["71C"]),
+                b.getvehicles(routes=["71C"]), b.getpatterns([1, 2]), b.getroutes())
+        time, dirs, stops, prd, vehic, ptr, routes = self.run_async(calls())
+        self.assertEqual(time, datetime(2014, 10, 12, 10, 21, 4))
+        self.assertEqual(set(dirs), {"INBOUND", "OUTBOUND"})
+        self.assertEqual(stops[0]["stpid"], '2564')
+        self.assertEqual(prd[0]["rt"], "71C")
+        self.assertEqual(vehic[0]["vid"], "5669")
+        self.assertTrue(len(ptr) > 0)
+        self.assertEqual(routes[0]["rt"], "12")
+        self.assertRaises(BustimeParameterError, self.bustime.getpatterns)
+        self.assertFalse(hasattr(self.bustime, "iterpatterns"))
+        self.assertFalse(hasattr(self.bustime, "iterstops"))
+
+    def test_error(self):
+        bustime = AsyncBusTime(BASE, "NOKEY", factory=AsyncErrorRequest)
+        self.assertRaises(BustimeError, self.run_async,
+            bustime.getpredictions("1"))
+        self.assertRaises(BustimeError, BusTime(BASE, "NOKEY",
+            factory=ErrorRequest).getpredictions, "1")
+
+    def test_concurrency(self):
+        bustime = AsyncBusTime(BASE, "NOKEY", factory=lambda: AsyncMockRequest(0.1))
+        async def many():
+            return await asyncio.gather(*[bustime.gettime() for i in range(2000)])
+        start = time.perf_counter()
+        self.assertEqual(len(self.run_async(many())), 2000)
+        self.assertLess(time.perf_counter() - start, 2)
+
+    def test_stops(self):
+        mock = AsyncSystemRequest()
+        stops = AsyncStops(AsyncBusTime(BASE, "NOKEY", factory=lambda: mock),
+            GreatCircleDistance(), concurrency=5)
+        prd = self.run_async(stops.next_busses("71C", "INBOUND",
+            GreatCircleTest.origin, 2000))
+        self.assertEqual([p["stpid"] for p in prd], [str(i) for i in range(49, -1, -1)])
+
+    def test_stops_timeout(self):
+        mock = AsyncCountingRequest(latency=0.2)
+        stops = AsyncStops(AsyncBusTime(BASE, "NOKEY", factory=lambda: mock),
+            GreatCircleDistance(), concurrency=2, timeout=0.1)
+        async def query():
+            try:
+                await stops.next_busses("71C", "INBOUND", GreatCircleTest.origin, 2000)
+            finally:
+                await asyncio.sleep(0.5)
+        self.assertRaises(TimeoutError, self.run_async, query())
+        #getstops, and the two batches that had started
+        self.assertEqual(mock.calls, 3)
+
+    def test_request(self):
+        server = ThreadingHTTPServer(("127.0.0.1", 0), _MockHandler)
+        thread = threading.Thread(target=server.serve_forever, daemon=True)
+        thread.start()
+        try:
+            base = "http://127.0.0.1:{0}/bustime/api/v2/".format(server.server_port)
+            bustime = AsyncBusTime(base + "{method}?key={key}&format={format}",
+                "NOKEY", factory=AsyncRequest)
+            stops = self.run_async(bustime.getstops("71C", "INBOUND"))
+            self.assertEqual(stops[0]["stpid"], '2564')
+        finally:
+            server.shutdown()
+            server.server_close()
+
+class CountingSystemRequest(SystemRequest):
+    def __init__(self, delay=0.05, stops=50):
+        super().__init__(delay, stops)
+        self.calls = 0
+        self.missing = set()
+        self.limited = False
+
+    def urlopen(self, url):
+        self.calls += 1
+        return super().urlopen(url)
+
+    def getpredictions(self, **kwargs):
+        """Like BusTime, answers for the stops it can, with an error entry
+        for each missing one."""
+        if self.limited:
+            return json.dumps({"bustime-response":
+                {"error": [{"msg": "Transaction limit exceeded"}]}})
+        ids = kwargs["stpid"][0].split(",")
+        found = [i for i in ids if i not in self.missing]
+        resp = {"bustime-response": {"prd": []}}
+        if found:
+            resp = json.loads(super().getpredictions(stpid=[",".join(found)]))
+        errors = [{"stpid": i, "msg": "No data found for parameter"}
+            for i in ids if i in self.missing]
+        if errors:
+            resp["bustime-response"]["error"] = errors
+        return json.dumps(resp)
+
+class BatcherTest(unittest.TestCase):
+    def setUp(self):
+        self.mock = CountingSystemRequest()
+        self.batcher = Batcher(BusTime(BASE, "NOKEY", factory=lambda: self.mock),
+            window=0.05)
+
+    def ask(self, ids):
+        results = [None] * len(ids)
+        barrier = threading.Barrier(len(ids))
+        def worker(i):
+            barrier.wait()
+            try:
+                results[i] = self.batcher.prediction(ids[i])
+            except BustimeError as e:
+                results[i] = e
+        threads = [threading.Thread(target=worker, args=(i,)) for i in range(len(ids))]
+        for t in threads:
+            t.start()
+        for t in threads:
+            t.join()
+        return results
+
+    def test_coalesce(self):
+        self.batcher.window = 5
+        ids = [str(i % 20) for i in range(60)]
+        results = self.ask(ids)
+        self.assertEqual(self.mock.calls, 2)
+        self.assertEqual(self.batcher.calls, 2)
+        for (i, r) in zip(ids, results):
+            self.assertEqual([p["stpid"] for p in r], [i])
+
+    def test_errors(self):
+        self.mock.missing.add("3")
+        results = self.ask([str(i) for i in range(5)])
+        self.assertIsInstance(results[3], BustimeError)
+        self.assertEqual(str(results[3]), "No data found for parameter")
+        self.assertEqual(results[4][0]["stpid"], "4")
+        self.assertEqual(self.mock.calls, 1)
+
+    def test_general_error(self):
+        self.mock.limited = True
+        results = self.ask([str(i) for i in range(5)])
+        self.assertTrue(all(str(r) == "Transaction limit exceeded" for r in results))
+        self.assertEqual(self.mock.calls, 1)
+
+    def test_getbatch(self):
+        self.mock.missing.add("2")
+        found, errors = self.batcher.api.getbatch("getpredictions", "prd", "stpid",
+            range(4), top=40)
+        self.assertEqual(sorted(found), ["0", "1", "3"])
+        self.assertEqual(found["3"][0]["stpid"], "3")
+        self.assertEqual(errors, {"2": "No data found for parameter"})
+        self.assertRaises(BustimeError, self.batcher.api.getpredictions, "1,2")
+        typed = BusTime(BASE, "NOKEY", factory=lambda: self.mock, typed=True)
+        found, errors = typed.getbatch("getpredictions", "prd", "stpid", ["1"],
+            Prediction)
+        self.assertIsInstance(found["1"][0], Prediction)
+
+    def test_other_kinds(self):
+        self.assertEqual(self.batcher.vehicle(5669)["vid"], "5669")
+        self.assertIsNone(self.batcher.vehicle(1))
+        self.assertEqual(len(self.batcher.route_vehicles("71C")), 1)
+        self.assertEqual(self.batcher.pattern(2363)["pid"], 2363)
+
+def _vehicle(vid, lat, tmstmp):
+    return {"vid": vid, "rt": "71C", "lat": str(lat), "lon": "-79.92",
+        "tmstmp": tmstmp}
+
+class FleetRequest(MockRequest):
+    """Serves a scripted sequence of getvehicles results."""
+    def __init__(self, ticks):
+        self.ticks = list(ticks)
+
+    def getvehicles(self, **kwargs):
+        vehicles = self.ticks.pop(0) if len(self.ticks) > 1 else self.ticks[0]
+        if not vehicles:
+            #BusTime has no empty answer, only an error per route
+            return json.dumps({"bustime-response": {"error": [{"rt": r,
+                "msg": "No data found for parameter"}
+                for r in kwargs["rt"][0].split(",")]}})
+        return json.dumps({"bustime-response": {"vehicle": vehicles}})
+
+class AsyncFleetRequest(FleetRequest):
+    async def urlopen(self, url):
+        return MockRequest.urlopen(self, url)
+
+class VehicleStreamTest(unittest.TestCase):
+    ticks = [
+        [_vehicle("1", 40.46, "12:00"), _vehicle("2", 40.47, "12:00")],
+        [_vehicle("1", 40.46, "12:00"), _vehicle("2", 40.47001, "12:01")],
+        [_vehicle("1", 40.461, "12:01"), _vehicle("3", 40.48, "12:01")],
+    ]
+
+    def test_tracker(self):
+        tracker = VehicleTracker(threshold=25, interval=10)
+        delta = tracker.update(self.ticks[0])
+        self.assertEqual([v["vid"] for v in delta.added], ["1", "2"])
+        delta = tracker.update(self.ticks[1])
+        self.assertFalse(any(delta))
+        self.assertEqual(tracker.interval, 5)
+        delta = tracker.update(self.ticks[2])
+        self.assertEqual([v["vid"] for v in delta.added], ["3"])
+        self.assertEqual([v["vid"] for v in delta.moved], ["1"])
+        self.assertEqual([v["vid"] for v in delta.removed], ["2"])
+        tracker.update(self.ticks[2])
+        tracker.update(self.ticks[2])
+        self.assertEqual(tracker.interval, 5 * 1.5 * 1.5)
+
+    def test_stream(self):
+        sleeps = []
+        bustime = BusTime(BASE, "NOKEY", factory=lambda: FleetRequest(self.ticks))
+        stream = stream_vehicles(bustime, ["71C"], 10, sleep=sleeps.append)
+        first, second = next(stream), next(stream)
+        self.assertEqual(len(first.added), 2)
+        self.assertEqual(len(second.removed), 1)
+        self.assertEqual(len(sleeps), 2)
+
+    def test_async_stream(self):
+        mock = AsyncFleetRequest(self.ticks)
+        bustime = AsyncBusTime(BASE, "NOKEY", factory=lambda: mock)
+        async def take():
+            stream = aio.stream_vehicles(bustime, ["71C"], 0.001)
+            return [await stream.__anext__(), await stream.__anext__()]
+        first, second = asyncio.run(take())
+        self.assertEqual(len(first.added), 2)
+        self.assertEqual(len(second.moved), 1)
+
+    def test_end_of_service(self):
+        ticks = [self.ticks[0], []]
+        sleeps = []
+        bustime = BusTime(BASE, "NOKEY", factory=lambda: FleetRequest(ticks))
+        stream = stream_vehicles(bustime, ["71C"], 10, sleep=sleeps.append)
+        self.assertEqual(len(next(stream).added), 2)
+        self.assertEqual([v["vid"] for v in next(stream).removed], ["1", "2"])
+        mock = AsyncFleetRequest(ticks)
+        client = AsyncBusTime(BASE, "NOKEY", factory=lambda: mock)
+        async def take():
+            stream = aio.stream_vehicles(client, ["71C"], 0.001)
+            return [await stream.__anext__(), await stream.__anext__()]
+        self.assertEqual(len(asyncio.run(take())[1].removed), 2)
+
+class ModelsTest(unittest.TestCase):
+    def setUp(self):
+        self.bustime = BusTime(BASE, "NOKEY", factory=MockRequest, typed=True)
+
+    def test_lazy(self):
+        vehicle = self.bustime.getvehicles(routes=["71C"])[0]
+        self.assertIsInstance(vehicle, Vehicle)
+        self.assertFalse(hasattr(vehicle, "__dict__"))
+        self.assertEqual(vehicle._lat, '40.46042251586914')
+        self.assertEqual(vehicle.lat, 40.46042251586914)
+        self.assertEqual(vehicle._lat, 40.46042251586914)
+        self.assertEqual(vehicle["hdg"], 299)
+        self.assertEqual(vehicle.tmstmp, datetime(2014, 10, 22, 12, 52))
+        self.assertRaises(KeyError, lambda: vehicle["nope"])
+
+    def test_typed(self):
+        prd = self.bustime.getpredictions("2564", ["71C"])[0]
+        self.assertIsInstance(prd, Prediction)
+        self.assertEqual(prd.prdtm, datetime(2014, 10, 22, 12, 37))
+        self.assertEqual(prd.get("rt"), "71C")
+        stop = self.bustime.getstops("71C", "INBOUND")[0]
+        self.assertEqual(stop, Stop.from_dict(BusTime(BASE, "NOKEY",
+            factory=MockRequest).getstops("71C", "INBOUND")[0]))
+        self.assertEqual("{lat},{lon}".format(**stop),
+            "40.441172012068,-79.959239533731")
+        stops = Stops(self.bustime, GreatCircleDistance())
+        self.assertEqual(len(stops.next_busses("71C", "INBOUND",
+            GreatCircleTest.origin)), 1)
+
+    def test_patterns(self):
+        raw = BusTime(BASE, "NOKEY", factory=MockRequest).getpatterns([2363])
+        ptr = self.bustime.getpatterns([2363])
+        self.assertIsInstance(ptr[0], Pattern)
+        points = ptr[0].pt
+        self.assertIsInstance(points, PatternPoints)
+        self.assertEqual(len(points), len(raw[0]["pt"]))
+        for (p, r) in zip(points, raw[0]["pt"]):
+            self.assertEqual((p.seq, p.typ, p.stpid, p.lat),
+                (r["seq"], r["typ"], r.get("stpid"), r["lat"]))
+        stops = [r for r in raw[0]["pt"] if r["typ"] == "S"]
+        self.assertEqual([p.stpid for p in points.stop_points()],
+            [r["stpid"] for r in stops])
+        self.assertEqual(points[-1].seq, raw[0]["pt"][-1]["seq"])
+        self.assertRaises(IndexError, lambda: points[-len(points) - 1])
+
+    def test_pattern_slices(self):
+        raw = BusTime(BASE, "NOKEY", factory=MockRequest).getpatterns([2363])[0]["pt"]
+        points = self.bustime.getpatterns([2363])[0].pt
+        for s in [slice(None, 2), slice(-3, None), slice(1, None, 2),
+                slice(None, None, -1), slice(5, 2)]:
+            self.assertEqual([p.seq for p in points[s]], [r["seq"] for r in raw[s]])
+        self.assertIsInstance(points[:2][0], PatternPoint)
+
+class TimeParseTest(unittest.TestCase):
+    def test_formats(self):
+        self.assertEqual(parse_time("20141022 12:37"), datetime(2014, 10, 22, 12, 37))
+        self.assertEqual(parse_time("20141012 10:21:04"),
+            datetime(2014, 10, 12, 10, 21, 4))
+        self.assertIs(parse_time("20141022 12:37"), parse_time("20141022 12:37"))
+
+    @unittest.skipIf(dateutil is None, "dateutil isn't installed")
+    def test_fallback(self):
+        self.assertEqual(parse_time("2014-10-22T12:37:00"),
+            datetime(2014, 10, 22, 12, 37))
+
+    @unittest.skipIf(dateutil is not None, "dateutil is installed")
+    def test_no_fallback(self):
+        self.assertRaises(ValueError, parse_time, "2014-10-22T12:37:00")
+
+    def test_timezone(self):
+        eastern = ZoneInfo("America/New_York")
+        dt = parse_time("20141022 12:37", "America/New_York")
+        self.assertEqual(dt, datetime(2014, 10, 22, 12, 37, tzinfo=eastern))
+        self.assertEqual(dt.utcoffset().total_seconds(), -4 * 60 * 60)
+        bustime = BusTime(BASE, "NOKEY", factory=MockRequest, tz=eastern)
+        self.assertEqual(bustime.gettime(),
+            datetime(2014, 10, 12, 10, 21, 4, tzinfo=eastern))
+
+    def test_typed_timezone(self):
+        eastern = ZoneInfo("America/New_York")
+        bustime = BusTime(BASE, "NOKEY", factory=MockRequest, typed=True,
+            tz="America/New_York")
+        prd = bustime.getpredictions("2564")[0]
+        self.assertIsInstance(prd, Prediction)
+        self.assertEqual(prd.prdtm, datetime(2014, 10, 22, 12, 37, tzinfo=eastern))
+        self.assertEqual(prd.prdtm - bustime.gettime(),
+            datetime(2014, 10, 22, 12, 37) - datetime(2014, 10, 12, 10, 21, 4))
+        self.assertEqual(bustime.getvehicles(routes=["71C"])[0].tmstmp.tzinfo, eastern)
+        self.assertIs(type(prd), Prediction.in_timezone("America/New_York"))
+        self.assertIs(Prediction.in_timezone(None), Prediction)
+        naive = BusTime(BASE, "NOKEY", factory=MockRequest, typed=True)
+        self.assertIsNone(naive.getpredictions("2564")[0].prdtm.tzinfo)
+
+class JSONStreamTest(unittest.TestCase):
+    doc = {"bustime-response": {"tm": "x", "stops": [
+        {"stpid": "1", "stpnm": "Esc\\aped \"name\" \u00e9", "lat": -4.5e-3,
+            "lon": 12, "big": 1E+10, "flags": [True, False, None], "empty": {}},
+        {"stpid": "2", "nested": {"a": [[], [1, -2]], "b": "} ] { ["}}]}}
+
+    def test_chunks(self):
+        raw = json.dumps(self.doc).encode("UTF8")
+        for chunk in range(1, 9):
+            stops = list(jsonstream.records(BytesIO(raw), "stops", chunk))
+            self.assertEqual(stops, self.doc["bustime-response"]["stops"])
+        compact = json.dumps(self.doc, separators=(",", ":")).encode("UTF8")
+        self.assertEqual(list(jsonstream.records(BytesIO(compact), "stops", 3)),
+            self.doc["bustime-response"]["stops"])
+
+    def test_bustime(self):
+        bustime = BusTime(BASE, "NOKEY", factory=MockRequest)
+        ptr = bustime.getpatterns([2363])
+        streamed = list(bustime.iterpatterns([2363]))
+        self.assertEqual([p for (meta, p) in streamed],
+            [p for pattern in ptr for p in pattern["pt"]])
+        self.assertEqual(streamed[-1][0]["pid"], ptr[-1]["pid"])
+        self.assertEqual(list(bustime.iterstops("71C", "INBOUND")),
+            bustime.getstops("71C", "INBOUND"))
+        self.assertRaises(BustimeParameterError, bustime.iterpatterns)
+
+    def test_unstarted(self):
+        mock = MockRequest()
+        pool = PooledRequest(pool_size=2, connection_factory=mock.connection,
+            acquire_timeout=0.1)
+        bustime = BusTime(BASE, "NOKEY", factory=lambda: pool)
+        for i in range(2):
+            bustime.iterstops("71C", "INBOUND")
+        gc.collect()
+        self.assertEqual(pool.connections_opened, 0)
+        bustime.gettime()
+        #ones started and abandoned part way give their connections back
+        started = [bustime.iterpatterns([2363]) for i in range(2)]
+        for points in started:
+            next(points)
+        del started, points
+        gc.collect()
+        bustime.gettime()
+
+    def test_early_error(self):
+        class Stream(BytesIO):
+            def read(self, n=-1):
+                data = super().read(n)
+                self.taken = self.tell()
+                return data
+        body = json.dumps({"bustime-response": {
+            "error": [{"msg": "No data found for parameter"}],
+            "ptr": [{"pid": 1, "pt": synthetic_points(5000)}]}}).encode("UTF8")
+        stream = Stream(body)
+        self.assertRaises(BustimeError, list, jsonstream.pattern_points(stream, 1024))
+        self.assertEqual(stream.taken, 1024)
+
+    def test_memory(self):
+        body = json.dumps({"bustime-response": {"ptr": [
+            {"pid": 1, "ln": 1.0, "rtdir": "INBOUND", "pt": synthetic_points(5000)}]}}
+            ).encode("UTF8")
+        def peak(fn):
+            tracemalloc.start()
+            try:
+                fn()
+                return tracemalloc.get_traced_memory()[1]
+            finally:
+                tracemalloc.stop()
+        def stream():
+            for (pattern, point) in jsonstream.pattern_points(BytesIO(body)):
+                pass
+        whole = peak(lambda: json.loads(body.decode("UTF8")))
+        self.assertLess(peak(stream) * 20, whole)
+
+class ETATest(unittest.TestCase):
+    def setUp(self):
+        self.mock = CountingRequest()
+        self.bustime = BusTime(BASE, "NOKEY", factory=lambda: self.mock)
+        self.pattern = [p for p in self.bustime.getpatterns(routes=["71C"])
+            if p["pid"] == 2363][0]
+        self.stops = [p for p in self.pattern["pt"] if p["typ"] == "S"]
+
+    def test_approaching(self):
+        engine = ETAEngine(self.bustime, ["71C"])
+        engine.refresh()
+        calls = self.mock.calls
+        ahead = [s for s in self.stops if s["pdist"] >= 17607]
+        behind = [s for s in self.stops if s["pdist"] < 17607]
+        self.assertTrue(ahead and behind)
+        for s in ahead:
+            found = engine.approaching(s["stpid"])
+            self.assertEqual(len(found), 1)
+            self.assertEqual(found[0][0], s["pdist"] - 17607)
+            self.assertEqual(found[0][1]["vid"], "5669")
+        self.assertEqual(engine.approaching(behind[-1]["stpid"]), [])
+        self.assertEqual(engine.approaching("nope"), [])
+        self.assertEqual(self.mock.calls, calls)
+
+    def test_no_vehicles(self):
+        mock = SyntheticRequest(routes=2, stops=20, points=20, vehicles=0)
+        engine = ETAEngine(BusTime(BASE, "NOKEY", factory=lambda: mock), ["1", "2"])
+        self.assertEqual(engine.refresh(), [])
+        self.assertEqual(engine.approaching("10005"), [])
+        mock.vehicles = 2
+        self.assertEqual(len(engine.refresh()), 4)
+
+    def test_positions(self):
+        vehicles = [{"vid": str(i), "pid": 1, "pdist": pdist}
+            for (i, pdist) in enumerate([500, 100, 900, 300])]
+        positions = Positions(vehicles)
+        self.assertEqual([(f, v["vid"]) for (f, v) in positions.upstream("1", 600)],
+            [(100, "0"), (300, "3"), (500, "1")])
+        self.assertEqual(positions.upstream("1", 50), [])
+        self.assertEqual(positions.upstream("2", 600), [])
+
+
+class SyntheticTest(unittest.TestCase):
+    def test_system(self):
+        mock = SyntheticRequest(routes=3, stops=50, points=200)
+        api = BusTime(BASE, "NOKEY", factory=lambda: mock)
+        self.assertEqual([r["rt"] for r in api.getroutes()], mock.routes)
+        stops = api.getstops("2", "INBOUND")
+        self.assertEqual(len(stops), 50)
+        pattern = api.getpatterns(routes=["2"])[0]
+        self.assertEqual(len(pattern["pt"]), 200)
+        engine = ETAEngine(api, ["2"])
+        engine.refresh()
+        self.assertTrue(any(engine.approaching(s["stpid"]) for s in stops))
+        self.assertEqual(mock.errors, 0)
+
+    def test_errors(self):
+        mock = SyntheticRequest(routes=1, stops=10, points=10, error_rate=1)
+        api = BusTime(BASE, "NOKEY", factory=lambda: mock)
+        self.assertRaises(BustimeError, api.getroutes)
+        self.assertEqual((mock.calls, mock.errors), (1, 1))
+
+    def test_latency(self):
+        mock = SyntheticRequest(routes=1, stops=10, points=10, latency=0.02)
+        api = BusTime(BASE, "NOKEY", factory=lambda: mock)
+        start = time.perf_counter()
+        api.getroutes()
+        self.assertGreaterEqual(time.perf_counter() - start, 0.02)
+
+    def test_bench(self):
+        out = io.StringIO()
+        with contextlib.redirect_stdout(out):
+            bench.main(["--repeat", "2", "--routes", "2", "--stops", "20",
+                "--points", "50", "--only", "buildurl", "--only", "next_busses",
+                "--json"])
+        results = json.loads(out.getvalue())["results"]
+        self.assertEqual([r["name"] for r in results], ["buildurl_x1000", "next_busses"])
+        self.assertTrue(all(r["op_errors"] == 0 for r in results))
+
+    def test_measure_errors(self):
+        calls = []
+        def flaky():
+            calls.append(1)
+            if len(calls) in (1, 3):
+                raise BustimeError("Transaction limit exceeded")
+        result = bench.measure("flaky", flaky, 4, traced=0)
+        self.assertEqual(result["op_errors"], 1)
+        self.assertEqual(result["first_error"], "BustimeError: Transaction limit exceeded")
+        self.assertEqual(result["warmup_error"], result["first_error"])
+        result = bench.measure("warm", lambda: None, 2, traced=0)
+        self.assertNotIn("first_error", result)
+        self.assertNotIn("warmup_error", result)
+
+
+class MetricsTest(unittest.TestCase):
+    def setUp(self):
+        self.mock = SyntheticRequest(routes=2, stops=60, points=100)
+        self.registry = Registry()
+        self.exported = []
+        self.metrics = Metrics(self.registry, self.exported.append)
+
+    def test_calls(self):
+        bustime = BusTime(BASE, "NOKEY", factory=lambda: self.mock, metrics=self.metrics)
+        stops = Stops(bustime, GreatCircleDistance())
+        try:
+            found = stops.next_busses("1", "INBOUND", {"lat": 40.4406, "lon": -79.9959}, 3000)
+        finally:
+            stops.close()
+        nearby = Stops(BusTime(BASE, "NOKEY", factory=lambda: self.mock),
+            GreatCircleDistance()).stops_in_range("1", "INBOUND",
+            {"lat": 40.4406, "lon": -79.9959}, 3000)
+        self.assertTrue(found)
+        batches = (len(nearby) + 9) // 10
+        self.assertEqual(self.registry.upstream_calls("getpredictions"), batches)
+        self.assertEqual(self.registry.upstream_calls(), batches + 1)
+        snap = self.registry.snapshot()
+        self.assertEqual(set(snap["getstops"]["spans"]),
+            {"connect", "transfer", "decode", "extract", "total"})
+        self.assertEqual(snap["getstops"]["spans"]["total"]["count"], 1)
+        self.assertTrue(snap["getpredictions"]["bytes"] > 0)
+        self.assertEqual(len(self.exported), batches + 1)
+        self.assertTrue(all(c.total >= sum(c.spans.values()) - 1e-9 for c in self.exported))
+
+    def test_errors(self):
+        self.mock.error_rate = 1
+        bustime = BusTime(BASE, "NOKEY", factory=lambda: self.mock, metrics=self.metrics)
+        for i in range(3):
+            self.assertRaises(BustimeError, bustime.getroutes)
+        self.assertRaises(BustimeParameterError, bustime.getvehicles)
+        self.assertEqual(self.registry.errors,
+            {("getroutes", "Transaction limit exceeded"): 3})
+        self.assertEqual(self.registry.snapshot()["getroutes"]["errors"],
+            {"Transaction limit exceeded": 3})
+
+    def test_cache(self):
+        bustime = BusTime(BASE, "NOKEY", factory=lambda: self.mock,
+            cache=ResponseCache(), metrics=self.metrics)
+        bustime.getstops("1", "INBOUND")
+        bustime.getstops("1", "INBOUND")
+        self.assertEqual(self.registry.calls["getstops"], 2)
+        self.assertEqual(self.registry.cache_hits["getstops"], 1)
+        self.assertEqual(self.registry.upstream_calls(), 1)
+        self.assertEqual(set(self.exported[1].spans), {"cache", "extract"})
+
+    def test_distance(self):
+        dist = Distance("NOKEY", window_size=20, factory=lambda: self.mock,
+            metrics=self.metrics)
+        dests = BusTime(BASE, "NOKEY", factory=lambda: self.mock).getstops("1", "INBOUND")
+        self.assertEqual(len(dist.distance_points({"lat": 40.4406, "lon": -79.9959},
+            *dests)), 60)
+        self.assertEqual(self.registry.calls, {"distancematrix": 3})
+        self.mock.error_rate = 1
+        self.assertRaises(IndexError, dist.distance_points,
+            {"lat": 40.4406, "lon": -79.9959}, *dests)
+        self.assertEqual(self.registry.errors, {("distancematrix", "IndexError"): 1})
+
+    def test_async(self):
+        bustime = AsyncBusTime(BASE, "NOKEY", factory=AsyncMockRequest,
+            metrics=self.metrics)
+        asyncio.run(bustime.getroutes())
+        self.assertEqual(self.registry.calls, {"getroutes": 1})
+        self.assertEqual(self.exported[0].api, "bustime")
+
+    def test_streaming(self):
+        bustime = BusTime(BASE, "NOKEY", factory=lambda: self.mock, metrics=self.metrics)
+        points = list(bustime.iterpatterns(routes=["1"]))
+        self.assertEqual(len(points), 120)
+        self.assertEqual(len(self.exported), 1)
+        call = self.exported[0]
+        self.assertEqual(call.method, "getpatterns")
+        self.assertEqual(set(call.spans), {"connect", "stream"})
+        self.assertEqual(call.bytes, len(self.mock.getpatterns(rt=["1"]).encode("UTF8")))
+        stops = bustime.iterstops("1", "INBOUND")
+        next(stops)
+        stops.close()
+        self.assertEqual(self.registry.calls["getstops"], 1)
+        self.assertEqual(self.registry.errors, {})
+
+    def test_disabled(self):
+        bustime = BusTime(BASE, "NOKEY", factory=lambda: self.mock)
+        self.assertIs(bustime.metrics, NULL_METRICS)
+        self.assertIs(Distance("NOKEY", factory=lambda: self.mock).metrics, NULL_METRICS)
+        self.assertEqual(len(bustime.getroutes()), 2)
+        self.assertEqual(len(list(bustime.iterstops("1", "INBOUND"))), 60)
+
+    def test_histogram(self):
+        h = Histogram()
+        for v in [0.001] * 98 + [1.0, 2.0]:
+            h.add(v)
+        self.assertEqual(h.count, 100)
+        self.assertTrue(0.001 <= h.percentile(0.5) < 0.002)
+        self.assertTrue(1.0 <= h.percentile(0.99) <= 2.0)
+        self.assertEqual(h.percentile(1), 2.0)
+        self.assertIsNone(Histogram().percentile(0.5))
+
+
+class SnapshotTest(unittest.TestCase):
+    def setUp(self):
+        self.mock = SyntheticRequest(routes=10, stops=200)
+        self.bustime = BusTime(BASE, "NOKEY", factory=lambda: self.mock)
+        self.dir = tempfile.TemporaryDirectory()
+        self.path = os.path.join(self.dir.name, "predictions.snap")
+
+    def tearDown(self):
+        self.dir.cleanup()
+
+    def test_build(self):
+        builder = SnapshotBuilder(self.bustime, self.path, workers=8)
+        try:
+            stats = builder.build()
+        finally:
+            builder.close()
+        self.assertEqual(stats["stops"], 4000)
+        self.assertEqual(stats["calls"], 400)
+        self.assertEqual(self.mock.calls, 1 + 10 * 3 + 400)
+        with Snapshot(self.path) as snap:
+            self.assertEqual(len(snap), 4000)
+            for stpid in ["10001", "20199", "105150"]:
+                self.assertEqual(snap.stop(stpid), self.bustime.getpredictions(stpid))
+            self.assertRaises(KeyError, snap.stop, "1")
+            route = snap.route("3")
+            self.assertTrue(route)
+            self.assertTrue(all(p["rt"] == "3" for p in route))
+            self.assertEqual([p["prdtm"] for p in route], sorted(p["prdtm"] for p in route))
+            self.assertEqual(snap.served_by("30005"), ["3"])
+            self.assertEqual(snap.route("nope"), [])
+        with Snapshot(self.path, typed=True) as snap:
+            self.assertIsInstance(snap.stop("10001")[0], Prediction)
+
+    def test_failures(self):
+        builder = SnapshotBuilder(self.bustime, self.path, workers=4)
+        try:
+            builder.refresh_stops()
+            #one stop in every batch has no service
+            self.mock.quiet.update(sorted(builder.stops)[::10])
+            stats = builder.build()
+            with Snapshot(self.path) as snap:
+                self.assertEqual(stats["calls"], 400)
+                self.assertEqual(stats["failed"], 400)
+                self.assertEqual(sorted(snap.failed), sorted(self.mock.quiet))
+                self.assertEqual(len(snap), 3600)
+                for stpid in snap.failed:
+                    self.assertNotIn(stpid, snap)
+                created = snap.created
+            self.mock.error_rate = 1
+            self.assertRaises(BustimeError, builder.build)
+        finally:
+            builder.close()
+        with Snapshot(self.path) as snap:
+            self.assertEqual(snap.created, created)
+
+    def test_failed_shard(self):
+        class Limited(SyntheticRequest):
+            limited = True
+            def getpredictions(self, **kwargs):
+                if self.limited and "10000" in kwargs["stpid"][0].split(","):
+                    return json.dumps({"bustime-response":
+                        {"error": [{"msg": "Transaction limit exceeded"}]}})
+                return super().getpredictions(**kwargs)
+        mock = Limited(routes=10, stops=200, latency=0.01)
+        builder = SnapshotBuilder(BusTime(BASE, "NOKEY", factory=lambda: mock),
+            self.path, workers=4)
+        try:
+            builder.refresh_stops()
+            before = mock.calls
+            self.assertRaises(BustimeError, builder.build)
+            builder.close()
+            #the other shards stop after the batch they were on
+            self.assertLessEqual(mock.calls - before, 8)
+            self.assertFalse(os.path.exists(self.path))
+            mock.limited = False
+            self.assertEqual(builder.build()["calls"], 400)
+        finally:
+            builder.close()
+
+    def test_write_failure(self):
+        self.assertRaises(TypeError, write_snapshot, self.path,
+            {"1": [{"rt": object()}]}, {"1": ("Stop 1", ["1"])}, {"1": ["1"]})
+        self.assertEqual(os.listdir(self.dir.name), [])
+
+    def test_reload(self):
+        builder = SnapshotBuilder(self.bustime, self.path)
+        sleeps = []
+        try:
+            stats = list(builder.run(interval=60, cycles=1, sleep=sleeps.append))
+            snap = Snapshot(self.path)
+            created = snap.created
+            self.assertFalse(snap.reload())
+            stats.extend(builder.run(interval=60, cycles=2, sleep=sleeps.append))
+        finally:
+            builder.close()
+        self.assertEqual(len(stats), 3)
+        self.assertEqual(len(sleeps), 1)
+        self.assertTrue(0 < sleeps[0] <= 60)
+        self.assertTrue(snap.reload())
+        self.assertTrue(snap.created > created)
+        self.assertEqual(len(snap), 4000)
+        snap.close()
+
+    def test_processes(self):
+        factory = functools.partial(SyntheticRequest, routes=10, stops=200)
+        builder = SnapshotBuilder(self.bustime, self.path, workers=2,
+            processes=True, factory=factory)
+        try:
+            stats = builder.build()
+        finally:
+            builder.close()
+        self.assertEqual(stats["stops"], 4000)
+        #only the stop directory is fetched in this process
+        self.assertEqual(self.mock.calls, 1 + 10 * 3)
+        with Snapshot(self.path) as snap:
+            self.assertEqual(snap.stop("20005"), self.bustime.getpredictions("20005"))
+
 
 if __name__ == '__main__':
     unittest.main()
\ No newline at end of file
@@ -0,0 +1,153 @@
+"""asyncio versions of BusTime and Stops, for serving many queries from one
+event loop without a thread per in-flight request."""
+import asyncio
+import inspect
+from io import BytesIO
+from urllib.error import HTTPError
+from urllib.parse import urlsplit
+from . import _BusTimeClient
+from .stops import batches, in_range, sort_predictions
+from .vehicles import VehicleTracker, group_vehicles, route_groups, vehicle_list
+
+
+class AsyncRequest:
+    """Minimal asyncio HTTP/1.1 client for GET requests.
+    Opens one connection per request. urlopen is a coroutine that returns
+    a readable response, like urllib.request.urlopen does."""
+    def __init__(self, timeout=10.0):
+        self.timeout = timeout
+
+    async def urlopen(self, url):
+        return await asyncio.wait_for(self.__get(url), self.timeout)
+
+    async def __get(self, url):
+        parts = urlsplit(url)
+        https = parts.scheme == "https"
+        port = parts.port or (443 if https else 80)
+        path = parts.path or "/"
+        if parts.query:
+            path += "?" + parts.query
+        reader, writer = await asyncio.open_connection(parts.hostname, port,
+            ssl=https or None)
+        try:
+            writer.write(("GET {0} HTTP/1.1\r\nHost: {1}\r\nConnection: close\r\n"
+                "Accept-Encoding: identity\r\n\r\n").format(path, parts.netloc)
+                .encode("ascii"))
+            status = (await reader.readline()).decode("latin-1").split(" ", 2)
+            code, reason = int(status[1]), status[2].strip() if len(status) > 2 else ""
+            headers = dict()
+            while True:
+                line = await reader.readline()
+                if line in (b"\r\n", b"\n", b""):
+                    break
+                k, v = line.decode("latin-1").split(":", 1)
+                headers[k.strip().lower()] = v.strip()
+            if headers.get("transfer-encoding", "").lower() == "chunked":
+                body = await _readchunked(reader)
+            elif "content-length" in headers:
+                body = await reader.readexactly(int(headers["content-length"]))
+            else:
+                body = await reader.read()
+        finally:
+            writer.close()
+        if code >= 400:
+            raise HTTPError(url, code, reason, headers, None)
+        return BytesIO(body)
+
+
+async def _readchunked(reader):
+    chunks = []
+    while True:
+        size = int((await reader.readline()).split(b";")[0], 16)
+        if size == 0:
+            await reader.readline()
+            return b"".join(chunks)
+        chunks.append(await reader.readexactly(size))
+        await reader.readline()
+
+
+class AsyncBusTime(_BusTimeClient):
+    """BusTime, where every API method is a coroutine:
+
+        >>> client = AsyncBusTime(BASE, API_KEY)
+        >>> await client.getroutes()
+
+    URL building, parameter checks and errors are the same as BusTime's;
+    parameter errors are raised when the method is called, not awaited.
+    The streaming iterpatterns and iterstops are BusTime only.
+    The factory must build a transport whose urlopen(url) is a coroutine,
+    like AsyncRequest or requestmock.AsyncMockRequest."""
+    def __init__(self, apibase, key, *, factory=AsyncRequest, cache=None,
+            typed=False, tz=None, metrics=None):
+        super().__init__(apibase, key, factory=factory, cache=cache,
+            typed=typed, tz=tz, metrics=metrics)
+
+    async def _call(self, method, extract, partial=False, **kwargs):
+        with self.metrics.call("bustime", method) as call:
+            resp = self._cached(method, call, kwargs)
+            if resp is None:
+                r = await self.request.urlopen(self.buildurl(method, **kwargs))
+                resp = self._receive(method, call, partial, kwargs, r)
+            result = extract(resp)
+            call.mark("extract")
+            return result
+
+
+class AsyncStops:
+    """Stops, for an AsyncBusTime. The distance client can be synchronous,
+    like GreatCircleDistance, or have a coroutine distance_points.
+    At most concurrency prediction batches are in flight per query. As with
+    Stops, if the batches for a query haven't all come back within timeout
+    seconds, TimeoutError is raised; if one fails, its error is. Either way
+    the other batches are cancelled, so they don't use up quota."""
+    def __init__(self, busapi, distanceapi, *, concurrency=4, timeout=None):
+        self.api = busapi
+        self.dist = distanceapi
+        self.concurrency = concurrency
+        self.timeout = timeout
+
+    async def stops_in_range(self, route, direction, location,
+        distance=400, duration=None):
+        """See Stops.stops_in_range."""
+        stops = await self.api.getstops(route, direction)
+        distances = self.dist.distance_points(location, *stops)
+        if inspect.isawaitable(distances):
+            distances = await distances
+        return in_range(distances, distance, duration)
+
+    async def next_busses(self, route, direction, location,
+        distance=400, duration=None):
+        """Check predictions for nearby stops, sorted by arrivals."""
+        stops = await self.stops_in_range(route, direction,
+            location, distance, duration)
+        ids = [s["stpid"] for s in stops]
+        limit = asyncio.Semaphore(self.concurrency)
+        async def fetch(batch):
+            async with limit:
+                return await self.api.getpredictions(batch, [route])
+        tasks = [asyncio.ensure_future(fetch(b)) for b in batches(ids)]
+        try:
+            results = await asyncio.wait_for(asyncio.gather(*tasks), self.timeout)
+        except asyncio.TimeoutError:
+            pending = len([t for t in tasks if not t.done()])
+            raise TimeoutError("{0} of {1} prediction batches took over {2}s".format(
+                pending, len(tasks), self.timeout)) from None
+        finally:
+            for t in tasks:
+                t.cancel()
+        return sort_predictions(p for batch in results for p in batch)
+
+
+async def stream_vehicles(busapi, routes, interval=10, *, threshold=25,
+        min_interval=None, max_interval=None):
+    """Async iterator version of vehicles.stream_vehicles, for AsyncBusTime.
+    The route groups are polled concurrently."""
+    tracker = VehicleTracker(threshold, interval, min_interval, max_interval)
+    groups = route_groups(routes)
+    while True:
+        results = await asyncio.gather(*[group_vehicles(busapi, g)
+            for g in groups])
+        delta = tracker.update([v for r in results for v in vehicle_list(r)])
+        if any(delta):
+            yield delta
+        await asyncio.sleep(tracker.interval)
@@ -0,0 +1,133 @@
+"""Coalesce single-id requests from many threads into multi-id BusTime calls.
+getpredictions, getvehicles and getpatterns all accept comma-joined ids, so
+callers asking for one stop, vehicle or pattern at a time can share calls."""
+import threading
+from collections import OrderedDict
+from concurrent.futures import Future
+from . import BustimeError
+from .models import Prediction, Vehicle, Pattern
+
+#the most ids BusTime accepts in a single call
+MAX_IDS = 10
+
+
+class Batcher:
+    """Dispatcher in front of a BusTime object. Single-id requests made
+    within window seconds of each other are merged into calls of up to
+    MAX_IDS ids, and the response is split back out to each caller.
+    Identical requests already waiting or in flight share one result.
+
+    BusTime reports an error for each id it has no data for alongside the
+    results for the rest, so only the callers whose ids failed see a
+    BustimeError. Errors that aren't about one id, like a transaction
+    limit, fail every caller in the batch.
+    calls counts the upstream calls made."""
+    def __init__(self, busapi, window=0.02, top=10):
+        self.api = busapi
+        self.window = window
+        self.top = top
+        self.calls = 0
+        self._lock = threading.Lock()
+        self._pending = dict()
+        self._inflight = dict()
+
+    def prediction(self, stpid, routes=None):
+        """Predictions for one stop, optionally limited to some routes.
+        Returns at most top predictions."""
+        group = ("prd", tuple(routes) if routes else None)
+        return self.__request(group, str(stpid))
+
+    def vehicle(self, vid):
+        """The vehicle with id vid, or None if it isn't reporting."""
+        return self.__request(("vid", None), str(vid))
+
+    def route_vehicles(self, route):
+        """The vehicles on a route."""
+        return self.__request(("rt", None), str(route))
+
+    def pattern(self, pid):
+        """The pattern with id pid."""
+        return self.__request(("pid", None), str(pid))
+
+    def flush(self):
+        """Dispatch everything waiting, without waiting out the window."""
+        for group in list(self._pending):
+            self.__flush(group)
+
+    def __request(self, group, key):
+        full = False
+        with self._lock:
+            future = self._inflight.get((group, key))
+            if future is None:
+                future = Future()
+                self._inflight[(group, key)] = future
+                pending = self._pending.setdefault(group, OrderedDict())
+                pending[key] = future
+                if len(pending) >= MAX_IDS:
+                    full = True
+                elif len(pending) == 1:
+                    timer = threading.Timer(self.window, self.__flush, (group,))
+                    timer.daemon = True
+                    timer.start()
+        if full:
+            self.__flush(group, full_only=True)
+        return future.result()
+
+    def __flush(self, group, full_only=False):
+        """Dispatch waiting requests in batches. When full_only, partial
+        batches are left for the window timer."""
+        while True:
+            with self._lock:
+                pending = self._pending.get(group)
+                if not pending or (full_only and len(pending) < MAX_IDS):
+                    return
+                batch = [pending.popitem(last=False) for i in
+                    range(min(MAX_IDS, len(pending)))]
+            self.__dispatch(group, OrderedDict(batch))
+
+    def __dispatch(self, group, batch):
+        try:
+            results, errors = self.__fetch(group, list(batch))
+        except Exception as e:
+            self.__finish(group, batch, exception=e)
+            return
+        self.__finish(group, batch, results=results, errors=errors)
+
+    def __fetch(self, group, keys):
+        """Make the merged call. Returns (results keyed by id, error
+        messages keyed by id)."""
+        kind, routes = group
+        with self._lock:
+            self.calls += 1
+        api = self.api
+        if kind == "prd":
+            kwargs = {"top": self.top * len(keys)}
+            if routes:
+                kwargs["rt"] = ",".join(routes)
+            found, errors = api.getbatch("getpredictions", "prd", "stpid", keys,
+                Prediction, **kwargs)
+            return dict((k, v[:self.top]) for (k, v) in found.items()), errors
+        if kind == "vid":
+            found, errors = api.getbatch("getvehicles", "vehicle", "vid", keys,
+                Vehicle, resolution="S")
+            return dict((k, v[0] if v else None) for (k, v) in found.items()), errors
+        if kind == "rt":
+            return api.getbatch("getvehicles", "vehicle", "rt", keys, Vehicle,
+                resolution="S")
+        found, errors = api.getbatch("getpatterns", "ptr", "pid", keys, Pattern)
+        return dict((k, v[0] if v else None) for (k, v) in found.items()), errors
+
+    def __finish(self, group, batch, results=None, errors=None, exception=None):
+        kind = group[0]
+        empty = None if kind in ("vid", "pid") else []
+        with self._lock:
+            for key in batch:
+                del self._inflight[(group, key)]
+        for (key, future) in batch.items():
+            if exception is not None:
+                future.set_exception(exception)
+            elif key in errors:
+                future.set_exception(BustimeError(errors[key]))
+            else:
+                future.set_result(results.get(key, empty))
+
@@ -0,0 +1,410 @@
+"""Benchmarks for the client's hot paths, against a generated transit system
+served by requestmock.SyntheticRequest. Run with:
+
+    $ python3 -m bustime.bench
+    $ python3 -m bustime.bench --latency 40 --jitter 10 --json > after.json
+    $ python3 -m bustime.bench --compare before.json
+
+Each benchmark reports throughput, p50/p99 latency per operation and the
+peak memory allocated during an operation (from a separate tracemalloc
+pass, so tracing doesn't skew the timings)."""
+import argparse
+import contextlib
+import json
+import os
+import platform
+import random
+import sys
+import tempfile
+import threading
+import time
+import tracemalloc
+import urllib.request
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from . import BusTime, BASE
+from .distance import Distance, GreatCircleDistance, haversine
+from .metrics import Metrics, Registry
+from .models import Prediction, Vehicle, PatternPoints
+from .requestmock import SyntheticRequest
+from .snapshot import SnapshotBuilder, Snapshot
+from .stopindex import StopIndex
+from .stops import Stops
+from .transport import PooledRequest
+
+PITTSBURGH = {"lat": 40.4406, "lon": -79.9959}
+
+
+def synthetic_stops(count, center=PITTSBURGH, spread=0.15, seed=1):
+    """Random stops scattered within spread degrees of center."""
+    rand = random.Random(seed)
+    return [{"stpid": str(i), "stpnm": "Stop {0}".format(i),
+            "lat": center["lat"] + rand.uniform(-spread, spread),
+            "lon": center["lon"] + rand.uniform(-spread, spread)}
+        for i in range(count)]
+
+
+def synthetic_predictions(count):
+    return [{"tmstmp": "20141022 12:31", "typ": "A", "stpnm": "5th Ave at Chesterfield Rd",
+            "stpid": str(i % 5000), "vid": str(5000 + i % 300), "dstp": 4198,
+            "rt": "71C", "rtdir": "INBOUND", "des": "Downtown",
+            "prdtm": "20141022 12:{0:02d}".format(i % 60), "dly": False,
+            "tablockid": "071C-150", "tatripid": str(159261 + i), "zone": "",
+            "prdctdn": str(i % 30)}
+        for i in range(count)]
+
+
+def synthetic_vehicles(count):
+    return [{"vid": str(i), "tmstmp": "20141022 12:52", "lat": "40.46042251586914",
+            "lon": "-79.92157814719461", "hdg": "299", "pid": 2363, "rt": "71C",
+            "des": "Downtown", "pdist": 17607, "dly": False, "spd": 0,
+            "tatripid": "159264", "tablockid": "071C-148", "zone": ""}
+        for i in range(count)]
+
+
+def synthetic_points(count):
+    return [{"seq": i, "typ": "S" if i % 4 == 0 else "W",
+            "lat": 40.44 + i * 1e-5, "lon": -79.99 + i * 1e-5,
+            "pdist": float(i * 30) if i % 4 == 0 else 0.0,
+            "stpid": str(i) if i % 4 == 0 else None,
+            "stpnm": "Stop {0}".format(i) if i % 4 == 0 else None}
+        for i in range(count)]
+
+
+def percentile(ordered, q):
+    return ordered[min(len(ordered) - 1, int(round(q * (len(ordered) - 1))))]
+
+
+def measure(name, fn, repeat, traced=3, **extra):
+    """Time repeat calls of fn(), after an untimed warm-up one, then trace
+    traced more for allocations. Timed calls that fail (as injected by
+    --error-rate) are counted in op_errors, and still timed; the first
+    one's error is first_error. A failed warm-up is reported as
+    warmup_error. Returns the result record for the benchmark."""
+    def attempt():
+        try:
+            fn()
+            return None
+        except Exception as e:
+            return "{0}: {1}".format(type(e).__name__, e)
+    warmup = attempt()
+    times = []
+    failures = []
+    for i in range(repeat):
+        start = time.perf_counter()
+        failure = attempt()
+        times.append(time.perf_counter() - start)
+        if failure is not None:
+            failures.append(failure)
+    times.sort()
+    peak = 0
+    tracemalloc.start()
+    try:
+        for i in range(traced):
+            tracemalloc.reset_peak()
+            before = tracemalloc.get_traced_memory()[0]
+            attempt()
+            peak = max(peak, tracemalloc.get_traced_memory()[1] - before)
+    finally:
+        tracemalloc.stop()
+    total = sum(times)
+    result = {
+        "name": name,
+        "ops": repeat,
+        "op_errors": len(failures),
+        "ops_per_s": repeat / total if total else float("inf"),
+        "p50_ms": percentile(times, 0.5) * 1000,
+        "p99_ms": percentile(times, 0.99) * 1000,
+        "peak_alloc_kb_per_op": peak / 1024,
+    }
+    if failures:
+        result["first_error"] = failures[0]
+    if warmup is not None:
+        result["warmup_error"] = warmup
+    result.update(extra)
+    return result
+
+
+def allocated(build):
+    """Bytes still allocated by the result of build()."""
+    tracemalloc.start()
+    try:
+        before = tracemalloc.get_traced_memory()[0]
+        result = build()
+        size = tracemalloc.get_traced_memory()[0] - before
+    finally:
+        tracemalloc.stop()
+    del result
+    return size
+
+
+def bench_buildurl(args, mock):
+    bustime = BusTime(BASE, "NOKEY", factory=lambda: mock)
+    def run():
+        for i in range(1000):
+            bustime.buildurl("getpredictions", stpid="1,2,3,4,5", rt="71C", top=10)
+    return measure("buildurl_x1000", run, args.repeat)
+
+
+def bench_decode(args, mock):
+    bustime = BusTime(BASE, "NOKEY", factory=lambda: mock)
+    routes = mock.routes[:2]
+    return measure("callrest_getpatterns", lambda: bustime.getpatterns(routes=routes),
+        args.repeat, points=2 * len(routes) * mock.points)
+
+
+def bench_stream(args, mock):
+    bustime = BusTime(BASE, "NOKEY", factory=lambda: mock)
+    routes = mock.routes[:2]
+    def run():
+        for pp in bustime.iterpatterns(routes=routes):
+            pass
+    return measure("iterpatterns", run, args.repeat,
+        points=2 * len(routes) * mock.points)
+
+
+@contextlib.contextmanager
+def local_server(mock):
+    """Serve mock over HTTP on localhost. Yields (apibase, connections),
+    where connections() is the number the server has accepted."""
+    accepted = [0]
+    class Handler(BaseHTTPRequestHandler):
+        protocol_version = "HTTP/1.1"
+        #headers and body go out in separate writes, which Nagle's algorithm
+        #would hold up on a kept-alive connection
+        disable_nagle_algorithm = True
+
+        def setup(self):
+            super().setup()
+            accepted[0] += 1
+
+        def do_GET(self):
+            body = mock.urlopen(self.path).read()
+            self.send_response(200)
+            self.send_header("Content-Type", "application/json")
+            self.send_header("Content-Length", str(len(body)))
+            self.end_headers()
+            self.wfile.write(body)
+
+        def log_message(self, *args):
+            pass
+    server = ThreadingHTTPServer(("127.0.0.1", 0), Handler)
+    thread = threading.Thread(target=server.serve_forever, daemon=True)
+    thread.start()
+    try:
+        yield ("http://127.0.0.1:{0}/bustime/api/v2/{{method}}?key={{key}}&format={{format}}"
+            .format(server.server_port), lambda: accepted[0])
+    finally:
+        server.shutdown()
+        server.server_close()
+
+
+def bench_transport(args, mock, calls=100):
+    """gettime through PooledRequest, both in-process (MockRequest.connection)
+    and against a local HTTP server, and through plain urllib against the
+    same server. Reports connections opened per 1,000 calls: the pool's
+    connections_opened, or for urllib, what the server accepted."""
+    def timed(name, bustime, opened):
+        made = [0]
+        def run():
+            for i in range(calls):
+                made[0] += 1
+                bustime.gettime()
+        result = measure(name + "_x{0}".format(calls), run, args.repeat)
+        result["connections_per_1000_calls"] = opened() * 1000 / made[0]
+        return result
+    results = []
+    pool = PooledRequest(connection_factory=mock.connection)
+    results.append(timed("transport_pooled_mock",
+        BusTime(BASE, "NOKEY", factory=lambda: pool),
+        lambda: pool.connections_opened))
+    with local_server(mock) as (base, accepted):
+        pool = PooledRequest()
+        try:
+            results.append(timed("transport_pooled_http",
+                BusTime(base, "NOKEY", factory=lambda: pool),
+                lambda: pool.connections_opened))
+        finally:
+            pool.close()
+        before = accepted()
+        results.append(timed("transport_urllib_http",
+            BusTime(base, "NOKEY", factory=lambda: urllib.request),
+            lambda: accepted() - before))
+    return results
+
+
+def bench_stops_in_range(args, mock):
+    bustime = BusTime(BASE, "NOKEY", factory=lambda: mock)
+    stops = Stops(bustime, GreatCircleDistance())
+    return measure("stops_in_range", lambda: stops.stops_in_range("1", "INBOUND",
+        PITTSBURGH, 5000), args.repeat, stops=mock.stops)
+
+
+def bench_next_busses(args, mock):
+    bustime = BusTime(BASE, "NOKEY", factory=lambda: mock)
+    stops = Stops(bustime, GreatCircleDistance(), max_workers=args.workers)
+    try:
+        return measure("next_busses", lambda: stops.next_busses("1", "INBOUND",
+            PITTSBURGH, 5000), args.repeat)
+    finally:
+        stops.close()
+
+
+def bench_distance(args, mock):
+    distance = Distance("NOKEY", factory=lambda: mock)
+    dests = BusTime(BASE, "NOKEY", factory=lambda: mock).getstops("1", "INBOUND")
+    return measure("distance_points", lambda: distance.distance_points(PITTSBURGH,
+        *dests), args.repeat, stops=len(dests))
+
+
+def bench_metrics(args, mock):
+    """getroutes with and without instrumentation, to show its overhead."""
+    results = []
+    for (name, metrics) in [("metrics_off", None), ("metrics_on", Metrics(Registry()))]:
+        bustime = BusTime(BASE, "NOKEY", factory=lambda: mock, metrics=metrics)
+        def run():
+            for i in range(100):
+                bustime.getroutes()
+        results.append(measure(name + "_getroutes_x100", run, args.repeat))
+    return results
+
+
+def bench_snapshot(args, mock):
+    """One snapshot cycle over the whole system, and reading it back."""
+    bustime = BusTime(BASE, "NOKEY", factory=lambda: mock)
+    with tempfile.TemporaryDirectory() as tmp:
+        path = os.path.join(tmp, "snapshot")
+        builder = SnapshotBuilder(bustime, path, workers=args.workers)
+        try:
+            #the stop directory, and a snapshot to read back, are setup, not
+            #part of what's measured, so they're made without injected errors
+            rate, mock.error_rate = mock.error_rate, 0
+            builder.refresh_stops()
+            builder.build()
+            mock.error_rate = rate
+            results = [measure("snapshot_build", builder.build, args.repeat,
+                traced=1, stops=len(builder.stops), bytes=os.path.getsize(path))]
+        finally:
+            builder.close()
+        with Snapshot(path) as snap:
+            ids = list(snap)[:1000]
+            def read():
+                for stpid in ids:
+                    snap.stop(stpid)
+            results.append(measure("snapshot_stop_x1000", read, args.repeat))
+    return results
+
+
+def bench_stopindex(args, mock):
+    stops = synthetic_stops(10000)
+    index = StopIndex()
+    for r in range(0, len(stops), 100):
+        index.add_stops(str(r), "INBOUND", stops[r:r + 100])
+    lat, lon = PITTSBURGH["lat"], PITTSBURGH["lon"]
+    linear = lambda: [s for s in stops
+        if haversine(lat, lon, s["lat"], s["lon"]) <= 400]
+    return [measure("stopindex_within", lambda: index.within(PITTSBURGH, 400),
+            args.repeat, stops=len(index)),
+        measure("stopindex_linear_scan", linear, args.repeat, stops=len(stops))]
+
+
+def bench_models(args, mock, count=100000):
+    """Bytes per record kept alive by the raw dicts, against the record
+    types built from them (once the dicts are gone)."""
+    results = []
+    for (name, make, build) in [
+            ("prediction", synthetic_predictions, Prediction.from_dicts),
+            ("vehicle", synthetic_vehicles, Vehicle.from_dicts),
+            ("pattern_point", synthetic_points, PatternPoints)]:
+        results.append({"name": "models_" + name, "records": count,
+            "dict_bytes_per_record": allocated(lambda: make(count)) / count,
+            "record_bytes_per_record": allocated(lambda: build(make(count))) / count})
+    return results
+
+
+BENCHMARKS = [
+    ("buildurl", bench_buildurl),
+    ("transport", bench_transport),
+    ("decode", bench_decode),
+    ("stream", bench_stream),
+    ("stops_in_range", bench_stops_in_range),
+    ("next_busses", bench_next_busses),
+    ("distance", bench_distance),
+    ("metrics", bench_metrics),
+    ("snapshot", bench_snapshot),
+    ("stopindex", bench_stopindex),
+    ("models", bench_models),
+]
+
+
+def run(args):
+    """Run the selected benchmarks, each against a fresh synthetic system.
+    A benchmark that raises (say, from an injected error) is reported
+    with the error instead of results."""
+    results = []
+    for (name, bench) in BENCHMARKS:
+        if args.only and name not in args.only:
+            continue
+        mock = SyntheticRequest(routes=args.routes, stops=args.stops,
+            points=args.points, latency=args.latency / 1000,
+            jitter=args.jitter / 1000, error_rate=args.error_rate)
+        try:
+            found = bench(args, mock)
+        except Exception as e:
+            found = {"name": name, "error": "{0}: {1}".format(type(e).__name__, e)}
+        found = found if isinstance(found, list) else [found]
+        for r in found:
+            r["upstream_calls"] = mock.calls
+            r["upstream_errors"] = mock.errors
+        results.extend(found)
+    return results
+
+
+def compare(results, path):
+    """Print each metric as a ratio against an earlier --json run."""
+    with open(path) as f:
+        old = dict((r["name"], r) for r in json.load(f)["results"])
+    for r in results:
+        before = old.get(r["name"])
+        if before is None:
+            continue
+        for (k, v) in r.items():
+            if isinstance(v, (int, float)) and before.get(k):
+                print("{0}.{1}: {2:.4g} -> {3:.4g} ({4:.2f}x)".format(
+                    r["name"], k, before[k], v, v / before[k]))
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(prog="python -m bustime.bench",
+        description="Benchmark the BusTime client against a synthetic system.")
+    parser.add_argument("--repeat", type=int, default=50, help="timed calls per benchmark")
+    parser.add_argument("--routes", type=int, default=20)
+    parser.add_argument("--stops", type=int, default=200, help="stops per route direction")
+    parser.add_argument("--points", type=int, default=2000, help="points per pattern")
+    parser.add_argument("--latency", type=float, default=0, help="per-call latency, ms")
+    parser.add_argument("--jitter", type=float, default=0, help="latency jitter, ms")
+    parser.add_argument("--error-rate", type=float, default=0)
+    parser.add_argument("--workers", type=int, default=4, help="next_busses and snapshot workers")
+    parser.add_argument("--only", action="append", help="run just these benchmarks",
+        choices=[name for (name, b) in BENCHMARKS])
+    parser.add_argument("--json", action="store_true", help="machine-readable output")
+    parser.add_argument("--compare", metavar="FILE", help="compare against a --json run")
+    args = parser.parse_args(argv)
+    results = run(args)
+    if args.json:
+        json.dump({"python": platform.python_version(),
+            "params": dict((k, v) for (k, v) in vars(args).items() if k != "compare"),
+            "results": results}, sys.stdout, indent=2)
+        print()
+    elif args.compare:
+        compare(results, args.compare)
+    else:
+        for r in results:
+            print(r["name"])
+            for (k, v) in r.items():
+                if k != "name":
+                    print("    {0}: {1:.4g}".format(k, v) if isinstance(v, float)
+                        else "    {0}: {1}".format(k, v))
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,138 @@
+"""Response cache for the BusTime endpoints that rarely change.
+Routes, directions, stops and patterns change about once a service period,
+so there's no reason to ask the server for them on every call."""
+import json
+import sqlite3
+import threading
+import time
+from collections import OrderedDict
+
+DAY = 24 * 60 * 60
+DEFAULT_TTLS = {
+    "getroutes": DAY,
+    "getdirections": DAY,
+    "getstops": DAY,
+    "getpatterns": DAY,
+    "getrtpidatafeeds": DAY,
+}
+
+
+class ResponseCache:
+    """LRU cache of parsed BusTime responses, keyed on method and parameters.
+    Pass it as BusTime(base, key, cache=ResponseCache()).
+
+    ttls maps method names to lifetimes in seconds; methods not in it are
+    never cached. max_bytes bounds the cache by the size of the raw response
+    bodies it holds. If a store (like SqliteStore) is given, responses are
+    also written through to it, so they survive a restart.
+
+    Cached responses are shared between callers, so don't mutate them."""
+    def __init__(self, ttls=None, max_bytes=16 * 1024 * 1024, store=None,
+            clock=time.time):
+        self.ttls = dict(DEFAULT_TTLS if ttls is None else ttls)
+        self.max_bytes = max_bytes
+        self.store = store
+        self.clock = clock
+        self.hits = 0
+        self.misses = 0
+        self.size = 0
+        self._entries = OrderedDict()
+        self._lock = threading.Lock()
+
+    def key(self, method, params, base=""):
+        """Build the cache key for a call. base identifies the server, so
+        one cache (or store) can be shared by clients for several agencies;
+        BusTime passes its apibase, which leaves out the API key."""
+        return base + " " + method + "".join("&{0}={1}".format(k, params[k])
+            for k in sorted(params))
+
+    def get(self, method, params, base=""):
+        """Return the cached response for a call, or None."""
+        key = self.key(method, params, base)
+        now = self.clock()
+        with self._lock:
+            entry = self._entries.get(key)
+            if entry is not None:
+                expires, size, resp = entry
+                if expires > now:
+                    self._entries.move_to_end(key)
+                    self.hits += 1
+                    return resp
+                del self._entries[key]
+                self.size -= size
+        if self.store is not None:
+            found = self.store.get(key, now)
+            if found is not None:
+                expires, body = found
+                resp = json.loads(body.decode("UTF8"))["bustime-response"]
+                with self._lock:
+                    self.hits += 1
+                    self.__insert(key, expires, len(body), resp)
+                return resp
+        with self._lock:
+            self.misses += 1
+        return None
+
+    def put(self, method, params, body, resp, base=""):
+        """Cache resp, the parsed form of the raw response body."""
+        key = self.key(method, params, base)
+        expires = self.clock() + self.ttls[method]
+        with self._lock:
+            self.__insert(key, expires, len(body), resp)
+        if self.store is not None:
+            self.store.put(key, expires, body)
+
+    def clear(self):
+        """Drop everything held in memory. The store is left alone."""
+        with self._lock:
+            self._entries.clear()
+            self.size = 0
+
+    def __insert(self, key, expires, size, resp):
+        if size > self.max_bytes:
+            return
+        old = self._entries.pop(key, None)
+        if old is not None:
+            self.size -= old[1]
+        self._entries[key] = (expires, size, resp)
+        self.size += size
+        while self.size > self.max_bytes:
+            _, (_, evicted, _) = self._entries.popitem(last=False)
+            self.size -= evicted
+
+    def __len__(self):
+        return len(self._entries)
+
+
+class SqliteStore:
+    """On-disk backing store for ResponseCache, kept in a sqlite file."""
+    def __init__(self, path):
+        self.path = path
+        self._lock = threading.Lock()
+        self._db = sqlite3.connect(path, check_same_thread=False)
+        with self._db:
+            self._db.execute("CREATE TABLE IF NOT EXISTS responses "
+                "(key TEXT PRIMARY KEY, expires REAL, body BLOB)")
+
+    def get(self, key, now):
+        """Returns (expires, body) for an unexpired key, otherwise None."""
+        with self._lock:
+            row = self._db.execute(
+                "SELECT expires, body FROM responses WHERE key = ?",
+                (key,)).fetchone()
+            if row is None:
+                return None
+            if row[0] <= now:
+                with self._db:
+                    self._db.execute("DELETE FROM responses WHERE key = ?", (key,))
+                return None
+        return row[0], bytes(row[1])
+
+    def put(self, key, expires, body):
+        with self._lock, self._db:
+            self._db.execute("INSERT OR REPLACE INTO responses VALUES (?, ?, ?)",
+                (key, expires, body))
+
+    def close(self):
+        with self._lock:
+            self._db.close()
@@ -1,11 +1,28 @@
-"""Wrapper for the Google DistanceMatrix API."""
-import urllib.request as request
+"""Wrapper for the Google DistanceMatrix API, and a local stand-in for it."""
 import json
+import math
+from array import array
+from .metrics import NULL_METRICS
+
+_numpy = False #not looked for yet; numpy is slow to import
+
+EARTH_RADIUS = 6371008.8 #mean radius, in meters
+
+def _request_factory():
+    import urllib.request
+    return urllib.request
+
 class Distance:
-    """Call the distancematrix API"""
-    def __init__(self, google_key, window_size=45):
+    """Call the distancematrix API.
+    factory works like BusTime's: it builds the object whose urlopen is
+    used to make requests. So does metrics; calls are recorded under
+    the method "distancematrix"."""
+    def __init__(self, google_key, window_size=45, *, factory=_request_factory,
+            metrics=None):
         self.key = google_key
         self.window_size = window_size
+        self.request = factory()
+        self.metrics = NULL_METRICS if metrics is None else metrics
 
     def format_point(self, point):
         """Format points as lat,lon"""
@@ -27,11 +44,11 @@ class Distance:
         #we window the call so that we're not trying to pass 1,000 points
         #on the URL and getting 400 errors. 45 appears to be a good
         #default size.
-        l = len(destinations)
-        if l < self.window_size:
-            return self.__distance_points(origin, *destinations)
-        else:
-            return list(self.__distance_points(origin, *destinations[:self.window_size])) + list(self.distance_points(origin, *destinations[self.window_size:]))
+        results = []
+        for i in range(0, len(destinations), self.window_size):
+            window = destinations[i:i + self.window_size]
+            results.extend(self.__distance_points(origin, *window))
+        return results
 
     def __call__(self, origin, *destinations):
         """Call the distance matrix API. See distance_points"""
@@ -43,9 +60,108 @@ class Distance:
         dests = self.join_points(*destinations)
         base = "https://maps.googleapis.com/maps/api/distancematrix/json?origins={0}&destinations={1}&mode=walking&key={2}" #I should externalize this.
         url = base.format(o, dests, self.key)
-        raw = request.urlopen(url).read()
-        data = json.loads(raw.decode("UTF8"))
-        data = data["rows"][0]["elements"]
+        with self.metrics.call("distancematrix", "distancematrix") as call:
+            r = self.request.urlopen(url)
+            call.mark("connect")
+            raw = r.read()
+            call.mark("transfer")
+            call.bytes = len(raw)
+            data = json.loads(raw.decode("UTF8"))["rows"][0]["elements"]
+            call.mark("decode")
         dist = [e["distance"] for e in data]
         dur = [e["duration"] for e in data]
         return zip(dist, dur, destinations)
+
+
+def haversine(lat1, lon1, lat2, lon2):
+    """Great-circle distance in meters between two lat/lon points."""
+    lat1, lon1, lat2, lon2 = map(math.radians,
+        (float(lat1), float(lon1), float(lat2), float(lon2)))
+    a = (math.sin((lat2 - lat1) / 2) ** 2 +
+        math.cos(lat1) * math.cos(lat2) * math.sin((lon2 - lon1) / 2) ** 2)
+    return 2 * EARTH_RADIUS * math.asin(math.sqrt(a))
+
+
+class GreatCircleDistance:
+    """Drop-in replacement for Distance that does the math locally instead of
+    calling the DistanceMatrix API. Distances are straight-line, so they
+    undercount real walking routes; durations are estimated from
+    walking_speed, in meters per second.
+
+    formula is "haversine", or "equirectangular", which is cheaper and
+    accurate enough over the few kilometers a stop search covers.
+    Uses numpy when it's installed."""
+    def __init__(self, walking_speed=1.4, formula="haversine"):
+        if formula not in ("haversine", "equirectangular"):
+            raise ValueError("Unknown formula: {0}".format(formula))
+        self.walking_speed = walking_speed
+        self.formula = formula
+
+    def distance_points(self, origin, *destinations):
+        """Same as Distance.distance_points: returns a list of
+        (distance, duration, stop) 3-tuples, where distance and duration
+        are dicts in the form {"value":n, "text":s}."""
+        speed = self.walking_speed
+        return [({"value": round(m), "text": _distance_text(m)},
+                {"value": round(m / speed), "text": _duration_text(m / speed)},
+                d)
+            for (m, d) in zip(self.meters(origin, destinations), destinations)]
+
+    def __call__(self, origin, *destinations):
+        return self.distance_points(origin, *destinations)
+
+    def meters(self, origin, destinations):
+        """Distances in meters from origin to each destination,
+        as one batch computation."""
+        lats = array("d", [float(d["lat"]) for d in destinations])
+        lons = array("d", [float(d["lon"]) for d in destinations])
+        lat, lon = float(origin["lat"]), float(origin["lon"])
+        if _load_numpy() is not None:
+            return self.__numpy_meters(lat, lon, lats, lons)
+        return self.__array_meters(lat, lon, lats, lons)
+
+    def __numpy_meters(self, lat, lon, lats, lons):
+        numpy = _numpy
+        lat, lon = math.radians(lat), math.radians(lon)
+        lats = numpy.radians(numpy.frombuffer(lats))
+        lons = numpy.radians(numpy.frombuffer(lons))
+        if self.formula == "equirectangular":
+            x = (lons - lon) * numpy.cos((lats + lat) / 2)
+            return (EARTH_RADIUS * numpy.hypot(x, lats - lat)).tolist()
+        a = (numpy.sin((lats - lat) / 2) ** 2 +
+            math.cos(lat) * numpy.cos(lats) * numpy.sin((lons - lon) / 2) ** 2)
+        return (2 * EARTH_RADIUS * numpy.arcsin(numpy.sqrt(a))).tolist()
+
+    def __array_meters(self, lat, lon, lats, lons):
+        lat, lon = math.radians(lat), math.radians(lon)
+        coslat = math.cos(lat)
+        out = array("d", bytes(8 * len(lats)))
+        sin, cos, sqrt = math.sin, math.cos, math.sqrt
+        for i in range(len(lats)):
+            la, lo = math.radians(lats[i]), math.radians(lons[i])
+            if self.formula == "equirectangular":
+                x = (lo - lon) * cos((la + lat) / 2)
+                out[i] = EARTH_RADIUS * math.hypot(x, la - lat)
+            else:
+                a = sin((la - lat) / 2) ** 2 + coslat * cos(la) * sin((lo - lon) / 2) ** 2
+                out[i] = 2 * EARTH_RADIUS * math.asin(sqrt(a))
+        return out
+
+
+def _load_numpy():
+    global _numpy
+    if _numpy is False:
+        try:
+            import numpy as _numpy
+        except ImportError:
+            _numpy = None
+    return _numpy
+
+def _distance_text(meters):
+    if meters < 1000:
+        return "{0} m".format(round(meters))
+    return "{0:.1f} km".format(meters / 1000)
+
+def _duration_text(seconds):
+    minutes = max(1, round(seconds / 60))
+    return "{0} min{1}".format(minutes, "" if minutes == 1 else "s")
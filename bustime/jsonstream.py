@@ -0,0 +1,196 @@
+"""Incremental JSON parsing straight from a response, in bytes.
+json.loads needs the whole body in memory (twice, once as bytes and once
+decoded); this reads fixed-size chunks and hands back one record at a time,
+so a getpatterns response with thousands of points never exists all at once."""
+import json
+import re
+
+CHUNK = 16 * 1024
+
+_TOKEN = re.compile(rb'[ \t\r\n]*(?:([\[\]{}:,])|("(?:[^"\\]|\\.)*")'
+    rb'|(-?\d+(?:\.\d+)?(?:[eE][+-]?\d+)?)|(true|false|null))')
+_SPACE = re.compile(rb'[ \t\r\n]*')
+_LITERALS = {b"true": True, b"false": False, b"null": None}
+
+
+_FLAT = re.compile(rb'(?:[^"{}\[\]]|"(?:[^"\\]|\\.)*")*[}\]]')
+_STRUCT = re.compile(rb'"(?:[^"\\]|\\.)*(")?|[\[\]{}]')
+
+
+class Parser:
+    """Reads a JSON document from fp a chunk at a time. Lets the caller step
+    through the containers it cares about, and build or skip whole values
+    it doesn't. Only the value being built is ever held in memory."""
+    def __init__(self, fp, chunk=CHUNK):
+        self.fp = fp
+        self.chunk = chunk
+        self.buf = b""
+        self.pos = 0
+        self.eof = False
+
+    def __fill(self, keep):
+        """Read another chunk, keeping the buffer from keep onwards.
+        Returns how far the buffer shifted."""
+        if self.eof:
+            raise ValueError("Unexpected end of JSON")
+        data = self.fp.read(self.chunk)
+        self.buf = self.buf[keep:] + data
+        self.pos -= keep
+        self.eof = not data
+        return keep
+
+    def next(self):
+        """The next token, as (kind, value): kind is "punct" for []{}:,
+        and "value" for everything else."""
+        while True:
+            m = _TOKEN.match(self.buf, self.pos)
+            #a number may continue in the next chunk, so only take one that's
+            #followed by something that can't be part of it
+            if m is None or (not self.eof and m.group(3) and (m.end() == len(self.buf)
+                    or self.buf[m.end()] in b".eE+-")):
+                if self.eof and m is None:
+                    if _SPACE.match(self.buf, self.pos).end() == len(self.buf):
+                        raise ValueError("Unexpected end of JSON")
+                    raise ValueError("Invalid JSON at: {0!r}".format(
+                        self.buf[self.pos:self.pos + 40]))
+                self.__fill(self.pos)
+                continue
+            self.pos = m.end()
+            punct, string, number, literal = m.groups()
+            if punct:
+                return "punct", punct
+            if string:
+                if b"\\" in string:
+                    return "value", json.loads(string)
+                return "value", string[1:-1].decode("UTF8")
+            if number:
+                if number.isdigit() or (number[0:1] == b"-" and number[1:].isdigit()):
+                    return "value", int(number)
+                return "value", float(number)
+            return "value", _LITERALS[literal]
+
+    def expect(self, punct):
+        token = self.next()
+        if token != ("punct", punct):
+            raise ValueError("Expected {0!r}, got {1!r}".format(punct, token))
+
+    def keys(self):
+        """After a '{', yield each key, leaving the parser at its value."""
+        kind, value = self.next()
+        if (kind, value) == ("punct", b"}"):
+            return
+        while True:
+            if kind != "value" or not isinstance(value, str):
+                raise ValueError("Expected a key, got {0!r}".format(value))
+            self.expect(b":")
+            yield value
+            kind, value = self.next()
+            if value == b"}":
+                return
+            if value != b",":
+                raise ValueError("Expected ',' or '}}', got {0!r}".format(value))
+            kind, value = self.next()
+
+    def items(self):
+        """After a '[', yield once per element, leaving the parser at it.
+        The caller must consume each element before asking for the next."""
+        kind, value = self.next()
+        if (kind, value) == ("punct", b"]"):
+            return
+        while True:
+            yield (kind, value)
+            kind, value = self.next()
+            if value == b"]":
+                return
+            if value != b",":
+                raise ValueError("Expected ',' or ']', got {0!r}".format(value))
+            kind, value = self.next()
+
+    def value(self, token=None):
+        """Build the next value (which starts with token, if given)."""
+        kind, value = self.next() if token is None else token
+        if kind == "value":
+            return value
+        if value not in (b"{", b"["):
+            raise ValueError("Unexpected {0!r}".format(value))
+        #find the matching close bracket, and decode just that slice.
+        #records are usually flat, which one regex can match.
+        start = self.pos - 1
+        m = _FLAT.match(self.buf, self.pos)
+        if m is not None:
+            self.pos = m.end()
+            return json.loads(self.buf[start:self.pos])
+        scan = self.pos
+        depth = 1
+        while True:
+            m = _STRUCT.search(self.buf, scan)
+            if m is None or (m.group(0)[:1] == b'"' and m.group(1) is None):
+                scan = m.start() if m is not None else len(self.buf)
+                scan -= self.__fill(start)
+                start = 0
+                continue
+            scan = m.end()
+            c = m.group(0)
+            if c in (b"{", b"["):
+                depth += 1
+            elif c in (b"}", b"]"):
+                depth -= 1
+                if depth == 0:
+                    self.pos = scan
+                    return json.loads(self.buf[start:scan])
+
+
+def _error(block):
+    from . import BustimeError
+    return BustimeError(block[0]["msg"])
+
+
+def _response(parser):
+    """Step into bustime-response, yielding its keys."""
+    parser.expect(b"{")
+    for key in parser.keys():
+        if key != "bustime-response":
+            parser.value()
+            continue
+        parser.expect(b"{")
+        yield from parser.keys()
+
+
+def records(fp, name, chunk=CHUNK):
+    """Yield the elements of the bustime-response[name] list, one at a time.
+    Raises BustimeError as soon as an error block is seen."""
+    parser = Parser(fp, chunk)
+    for key in _response(parser):
+        if key == "error":
+            raise _error(parser.value())
+        if key != name:
+            parser.value()
+            continue
+        parser.expect(b"[")
+        for token in parser.items():
+            yield parser.value(token)
+
+
+def pattern_points(fp, chunk=CHUNK):
+    """Yield (pattern, point) pairs from a getpatterns response.
+    pattern is a dict of the pattern's other fields; it's shared by all of
+    its points, and only holds the fields that came before "pt"."""
+    parser = Parser(fp, chunk)
+    for key in _response(parser):
+        if key == "error":
+            raise _error(parser.value())
+        if key != "ptr":
+            parser.value()
+            continue
+        parser.expect(b"[")
+        for token in parser.items():
+            if token != ("punct", b"{"):
+                raise ValueError("Expected a pattern, got {0!r}".format(token))
+            pattern = dict()
+            for field in parser.keys():
+                if field != "pt":
+                    pattern[field] = parser.value()
+                    continue
+                parser.expect(b"[")
+                for t in parser.items():
+                    yield pattern, parser.value(t)
@@ -0,0 +1,229 @@
+"""Instrumentation for API calls. Pass a Metrics to BusTime, AsyncBusTime
+or Distance, and every call reports where its time went:
+
+    >>> registry = Registry()
+    >>> client = BusTime(BASE, API_KEY, metrics=Metrics(registry))
+    >>> registry.snapshot()
+
+A sink is any callable that takes a finished Call, so exporting is a
+matter of passing a function alongside (or instead of) the Registry.
+Without metrics, the clients use NULL_METRICS, which records nothing."""
+import threading
+import time
+from bisect import bisect_left
+
+#upper bounds of the span histogram buckets, in seconds: 0.1ms to ~100s
+BOUNDS = tuple(0.0001 * 2 ** i for i in range(21))
+
+
+class Call:
+    """One API call. spans maps a phase to its duration in seconds:
+    "connect" (until urlopen returns), "transfer" (reading the body),
+    "decode" (JSON) and "extract" (pulling the result out of the response).
+    A call answered from the cache has "cache" (the lookup) in place of
+    the first three, and a streamed one (like iterpatterns) has "stream"
+    (reading and parsing, which are interleaved) after "connect"."""
+    __slots__ = ("api", "method", "spans", "bytes", "cached", "error",
+        "start", "_clock", "_last")
+
+    def __init__(self, api, method, clock):
+        self.api = api
+        self.method = method
+        self.spans = dict()
+        self.bytes = 0
+        self.cached = False
+        self.error = None
+        self._clock = clock
+        self.start = self._last = clock()
+
+    def mark(self, phase):
+        """End phase, starting the next one."""
+        now = self._clock()
+        self.spans[phase] = now - self._last
+        self._last = now
+
+    @property
+    def total(self):
+        return self._last - self.start
+
+
+def _error_key(error):
+    from . import BustimeError
+    if isinstance(error, BustimeError):
+        return str(error)
+    return type(error).__name__
+
+
+class Metrics:
+    """Hands each finished Call to every sink."""
+    def __init__(self, *sinks, clock=time.perf_counter):
+        self.sinks = list(sinks)
+        self.clock = clock
+
+    def start(self, api, method):
+        return Call(api, method, self.clock)
+
+    def finish(self, call, error=None):
+        """Record call, which failed with error if that's given: a
+        BustimeError by its message, anything else by its type."""
+        if error is not None:
+            call.error = _error_key(error)
+        call._last = self.clock()
+        for sink in self.sinks:
+            sink(call)
+
+    def call(self, api, method):
+        """Context manager timing the call made inside the with block.
+        An exception escaping it is recorded as the call's error."""
+        return _Timed(self, self.start(api, method))
+
+
+class _Timed:
+    __slots__ = ("metrics", "call")
+
+    def __init__(self, metrics, call):
+        self.metrics = metrics
+        self.call = call
+
+    def __enter__(self):
+        return self.call
+
+    def __exit__(self, kind, error, tb):
+        self.metrics.finish(self.call, error if isinstance(error, Exception) else None)
+        return False
+
+
+class _NullCall:
+    """Takes the same marks as a Call, and ignores them."""
+    cached = False
+    bytes = 0
+
+    def __setattr__(self, name, value):
+        pass
+
+    def mark(self, phase):
+        pass
+
+
+class _NullMetrics:
+    """Metrics that record nothing, so the clients can always time their
+    calls and cost next to nothing when nobody's looking."""
+    def start(self, api, method):
+        return NULL_CALL
+
+    def finish(self, call, error=None):
+        pass
+
+    def call(self, api, method):
+        return self
+
+    def __enter__(self):
+        return NULL_CALL
+
+    def __exit__(self, *exc):
+        return False
+
+
+NULL_CALL = _NullCall()
+NULL_METRICS = _NullMetrics()
+
+
+class Histogram:
+    """Counts of values in fixed, exponentially sized buckets."""
+    def __init__(self, bounds=BOUNDS):
+        self.bounds = bounds
+        self.counts = [0] * (len(bounds) + 1)
+        self.count = 0
+        self.sum = 0.0
+        self.min = None
+        self.max = None
+
+    def add(self, value):
+        self.counts[bisect_left(self.bounds, value)] += 1
+        self.count += 1
+        self.sum += value
+        self.min = value if self.min is None else min(self.min, value)
+        self.max = value if self.max is None else max(self.max, value)
+
+    def percentile(self, q):
+        """Upper bound of the bucket holding the q quantile, or max if
+        that's lower."""
+        if not self.count:
+            return None
+        rank = q * self.count
+        seen = 0
+        for (i, n) in enumerate(self.counts):
+            seen += n
+            if seen >= rank and n:
+                bound = self.bounds[i] if i < len(self.bounds) else self.max
+                return min(bound, self.max)
+        return self.max
+
+    def to_dict(self):
+        return {"count": self.count, "sum": self.sum, "min": self.min,
+            "max": self.max, "p50": self.percentile(0.5),
+            "p99": self.percentile(0.99)}
+
+
+class Registry:
+    """In-memory sink. Keeps, per method: calls, cache hits, bytes received,
+    errors by message and a histogram for each span. Safe to share
+    between threads."""
+    def __init__(self, bounds=BOUNDS):
+        self.bounds = bounds
+        self.calls = dict()
+        self.cache_hits = dict()
+        self.bytes = dict()
+        self.errors = dict()
+        self.spans = dict()
+        self.lock = threading.Lock()
+
+    def __call__(self, call):
+        method = call.method
+        with self.lock:
+            self.calls[method] = self.calls.get(method, 0) + 1
+            if call.cached:
+                self.cache_hits[method] = self.cache_hits.get(method, 0) + 1
+            self.bytes[method] = self.bytes.get(method, 0) + call.bytes
+            if call.error is not None:
+                key = (method, call.error)
+                self.errors[key] = self.errors.get(key, 0) + 1
+            for (phase, seconds) in call.spans.items():
+                self.__histogram(method, phase).add(seconds)
+            self.__histogram(method, "total").add(call.total)
+
+    def __histogram(self, method, phase):
+        key = (method, phase)
+        if key not in self.spans:
+            self.spans[key] = Histogram(self.bounds)
+        return self.spans[key]
+
+    def upstream_calls(self, method=None):
+        """Calls that weren't answered from the cache, for one method
+        or all of them."""
+        with self.lock:
+            if method is not None:
+                return self.calls.get(method, 0) - self.cache_hits.get(method, 0)
+            return sum(self.calls.values()) - sum(self.cache_hits.values())
+
+    def snapshot(self):
+        """Everything recorded so far, as plain dicts keyed by method."""
+        with self.lock:
+            out = dict()
+            for (method, n) in self.calls.items():
+                out[method] = {"calls": n,
+                    "cache_hits": self.cache_hits.get(method, 0),
+                    "bytes": self.bytes.get(method, 0),
+                    "errors": dict((e, c) for ((m, e), c) in self.errors.items()
+                        if m == method),
+                    "spans": dict((p, h.to_dict()) for ((m, p), h) in self.spans.items()
+                        if m == method)}
+            return out
+
+    def clear(self):
+        with self.lock:
+            self.calls.clear()
+            self.cache_hits.clear()
+            self.bytes.clear()
+            self.errors.clear()
+            self.spans.clear()
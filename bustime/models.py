@@ -0,0 +1,209 @@
+"""Compact record types for BusTime results.
+Records keep their fields in __slots__ instead of a dict per object, and
+convert string fields (coordinates, timestamps) on first access. They also
+support item access, so code written against the raw dicts keeps working:
+record["lat"] is the same as record.lat."""
+from array import array
+from .timeparse import parse_time as _timestamp
+
+
+class _Lazy:
+    """A field stored raw in a slot, and converted the first time it's read."""
+    def __init__(self, slot, convert):
+        self.slot = slot
+        self.convert = convert
+
+    def __get__(self, obj, cls):
+        if obj is None:
+            return self
+        value = getattr(obj, self.slot)
+        if isinstance(value, str):
+            value = self.convert(value)
+            setattr(obj, self.slot, value)
+        return value
+
+    def __set__(self, obj, value):
+        setattr(obj, self.slot, value)
+
+
+class Record:
+    """Base for the record types. Subclasses list their public names in
+    fields, and declare a slot for each (prefixed with _ for lazy fields)."""
+    __slots__ = ()
+    fields = ()
+
+    def __init_subclass__(cls, **kwargs):
+        super().__init_subclass__(**kwargs)
+        cls._slotnames = tuple(
+            (f, getattr(cls, f).slot if isinstance(getattr(cls, f, None), _Lazy) else f)
+            for f in cls.fields)
+
+    @classmethod
+    def from_dict(cls, d):
+        """Build a record from a raw BusTime dict. Unknown keys are dropped."""
+        obj = cls.__new__(cls)
+        for (field, slot) in cls._slotnames:
+            setattr(obj, slot, d.get(field))
+        return obj
+
+    @classmethod
+    def from_dicts(cls, ds):
+        return [cls.from_dict(d) for d in ds]
+
+    @classmethod
+    def in_timezone(cls, tz):
+        """This record type, with its timestamps read as aware datetimes in
+        tz (a tzinfo or zone name). Returns cls itself if tz is None."""
+        if tz is None:
+            return cls
+        zoned = _zoned.get((cls, tz))
+        if zoned is None:
+            attrs = {"__slots__": ()}
+            for f in cls.fields:
+                lazy = getattr(cls, f, None)
+                if isinstance(lazy, _Lazy) and lazy.convert is _timestamp:
+                    attrs[f] = _Lazy(lazy.slot, lambda value: _timestamp(value, tz))
+            zoned = _zoned[(cls, tz)] = type(cls.__name__, (cls,), attrs)
+        return zoned
+
+    def __getitem__(self, key):
+        if key not in self.fields:
+            raise KeyError(key)
+        return getattr(self, key)
+
+    def get(self, key, default=None):
+        if key not in self.fields:
+            return default
+        return getattr(self, key)
+
+    def keys(self):
+        return self.fields
+
+    def __contains__(self, key):
+        return key in self.fields
+
+    def __iter__(self):
+        return iter(self.fields)
+
+    def to_dict(self):
+        return dict((f, getattr(self, f)) for f in self.fields)
+
+    def __eq__(self, other):
+        if type(other) is not type(self):
+            return NotImplemented
+        return all(getattr(self, f) == getattr(other, f) for f in self.fields)
+
+    def __repr__(self):
+        return "{0}({1})".format(type(self).__name__, ", ".join(
+            "{0}={1!r}".format(f, getattr(self, f)) for f in self.fields))
+
+
+#record types made by Record.in_timezone, keyed on (type, tz)
+_zoned = dict()
+
+
+class Stop(Record):
+    """A getstops result."""
+    __slots__ = ("stpid", "stpnm", "_lat", "_lon")
+    fields = ("stpid", "stpnm", "lat", "lon")
+    lat = _Lazy("_lat", float)
+    lon = _Lazy("_lon", float)
+
+
+class Prediction(Record):
+    """A getpredictions result. prdtm and tmstmp are datetimes in the
+    agency's local time: naive, unless the client was given a tz."""
+    __slots__ = ("typ", "stpnm", "stpid", "vid", "dstp", "rt",
+        "rtdir", "des", "_prdtm", "dly", "tablockid", "tatripid", "zone",
+        "prdctdn", "_tmstmp")
+    fields = ("tmstmp", "typ", "stpnm", "stpid", "vid", "dstp", "rt",
+        "rtdir", "des", "prdtm", "dly", "tablockid", "tatripid", "zone",
+        "prdctdn")
+    prdtm = _Lazy("_prdtm", _timestamp)
+    tmstmp = _Lazy("_tmstmp", _timestamp)
+
+
+class Vehicle(Record):
+    """A getvehicles result. lat and lon are floats, hdg an int, and
+    tmstmp a datetime (aware, if the client was given a tz)."""
+    __slots__ = ("vid", "_tmstmp", "_lat", "_lon", "_hdg", "pid", "rt", "des",
+        "pdist", "dly", "spd", "tatripid", "tablockid", "zone")
+    fields = ("vid", "tmstmp", "lat", "lon", "hdg", "pid", "rt", "des",
+        "pdist", "dly", "spd", "tatripid", "tablockid", "zone")
+    tmstmp = _Lazy("_tmstmp", _timestamp)
+    lat = _Lazy("_lat", float)
+    lon = _Lazy("_lon", float)
+    hdg = _Lazy("_hdg", int)
+
+
+class PatternPoint(Record):
+    """One point of a pattern. stpid and stpnm are None for waypoints."""
+    __slots__ = ("seq", "typ", "stpid", "stpnm", "pdist", "_lat", "_lon")
+    fields = ("seq", "typ", "stpid", "stpnm", "pdist", "lat", "lon")
+    lat = _Lazy("_lat", float)
+    lon = _Lazy("_lon", float)
+
+
+class Pattern(Record):
+    """A getpatterns result, with its points in a PatternPoints."""
+    __slots__ = ("pid", "ln", "rtdir", "pt")
+    fields = ("pid", "ln", "rtdir", "pt")
+
+    @classmethod
+    def from_dict(cls, d):
+        obj = super().from_dict(d)
+        obj.pt = PatternPoints(d.get("pt", ()))
+        return obj
+
+
+class PatternPoints:
+    """Columnar list of pattern points: one array per field, rather than one
+    object per point. Indexing builds a PatternPoint on demand, and slicing
+    a list of them, as slicing the list of dicts would.
+    Stop names and ids are only stored for the stop points."""
+    __slots__ = ("seq", "typ", "lat", "lon", "pdist", "stops")
+
+    def __init__(self, points=()):
+        self.seq = array("l")
+        self.typ = bytearray()
+        self.lat = array("d")
+        self.lon = array("d")
+        self.pdist = array("d")
+        self.stops = dict()
+        for p in points:
+            self.append(p)
+
+    def append(self, point):
+        if point.get("stpid") is not None:
+            self.stops[len(self.seq)] = (point["stpid"], point.get("stpnm"))
+        self.seq.append(int(point["seq"]))
+        self.typ += point["typ"].encode("ascii")
+        self.lat.append(float(point["lat"]))
+        self.lon.append(float(point["lon"]))
+        self.pdist.append(float(point.get("pdist") or 0))
+
+    def __len__(self):
+        return len(self.seq)
+
+    def __getitem__(self, i):
+        if isinstance(i, slice):
+            return [self[j] for j in range(*i.indices(len(self)))]
+        if i < 0:
+            i += len(self)
+            if i < 0:
+                raise IndexError("pattern point index out of range")
+        point = PatternPoint.__new__(PatternPoint)
+        point.seq = self.seq[i]
+        point.typ = chr(self.typ[i])
+        point.stpid, point.stpnm = self.stops.get(i, (None, None))
+        point.pdist = self.pdist[i]
+        point.lat = self.lat[i]
+        point.lon = self.lon[i]
+        return point
+
+    def __iter__(self):
+        return (self[i] for i in range(len(self)))
+
+    def stop_points(self):
+        """Just the stop points, in order."""
+        return [self[i] for i in sorted(self.stops)]
@@ -1,6 +1,52 @@
 from urllib.parse import urlparse, parse_qs
 from io import BytesIO
+import asyncio
 import json
+import math
+import random
+import threading
+import time
+
+class MockConnection:
+    """Stands in for http.client.HTTPConnection, answering from a MockRequest.
+    Set stale to make the next request fail like a socket the server closed."""
+    def __init__(self, mock):
+        self.mock = mock
+        self.stale = False
+        self.requests = 0
+        self.__pending = None
+
+    def request(self, method, path, headers=None):
+        if self.stale:
+            raise ConnectionResetError("stale connection")
+        self.requests += 1
+        self.__pending = self.mock.urlopen("http://mock" + path)
+
+    def getresponse(self):
+        body, self.__pending = self.__pending, None
+        return MockResponse(body.read())
+
+    def close(self):
+        self.stale = True
+
+class MockResponse:
+    """Minimal http.client.HTTPResponse with a keep-alive body."""
+    status = 200
+    reason = "OK"
+    will_close = False
+
+    def __init__(self, body):
+        self.msg = {"Content-Length": str(len(body))}
+        self.__body = BytesIO(body)
+        self.__left = len(body)
+
+    def read(self, amt=None):
+        data = self.__body.read(amt)
+        self.__left -= len(data)
+        return data
+
+    def isclosed(self):
+        return self.__left <= 0
 
 class MockRequest:
     def getmethod(self, path):
@@ -19,6 +65,11 @@ class MockRequest:
         output.seek(0)
         return output
 
+    def connection(self, scheme, host, port, timeout=None):
+        """Connection factory for PooledRequest, serving this mock
+        in-process instead of over a socket."""
+        return MockConnection(self)
+
     def gettime(self, **kwargs):
         return json.dumps(
             {"bustime-response": {"tm": "20141012 10:21:04"}}
@@ -86,22 +137,205 @@ class MockRequest:
             })
 
 
+class AsyncMockRequest(MockRequest):
+    """MockRequest for AsyncBusTime: urlopen is a coroutine.
+    delay simulates network latency, in seconds."""
+    def __init__(self, delay=0):
+        self.delay = delay
 
+    async def urlopen(self, url):
+        if self.delay:
+            await asyncio.sleep(self.delay)
+        return MockRequest.urlopen(self, url)
 
 
+FEET_PER_METER = 3.28084
 
+class SyntheticRequest(MockRequest):
+    """Serves a generated transit system, for benchmarks and load tests.
+    There are routes routes, each with stops stops per direction, laid out
+    as spokes from downtown Pittsburgh; patterns have points points each.
+    Also answers Google DistanceMatrix requests, so it can back Distance.
 
+    Every call sleeps for latency seconds, plus or minus up to jitter, and
+    fails with probability error_rate (with a BusTime error block, or a
+    DistanceMatrix OVER_QUERY_LIMIT).
+    Stops in quiet have no predictions; like BusTime, getpredictions
+    reports an error entry for each of them alongside the other stops'.
+    getvehicles does the same for routes with no vehicles, and vehicle
+    ids it doesn't know.
+    calls and errors count what's been served."""
+    CENTER = (40.4406, -79.9959)
 
+    def __init__(self, routes=20, stops=200, points=2000, vehicles=5,
+            latency=0.0, jitter=0.0, error_rate=0.0, seed=1, quiet=()):
+        self.routes = [str(r + 1) for r in range(routes)]
+        self.stops = stops
+        self.points = max(points, stops)
+        self.vehicles = vehicles
+        self.latency = latency
+        self.jitter = jitter
+        self.error_rate = error_rate
+        self.quiet = set(quiet)
+        self.rand = random.Random(seed)
+        self.calls = 0
+        self.errors = 0
+        self.lock = threading.Lock()
 
+    def urlopen(self, url):
+        delay = self.latency + self.rand.uniform(-self.jitter, self.jitter)
+        if delay > 0:
+            time.sleep(delay)
+        with self.lock:
+            self.calls += 1
+            failed = self.error_rate and self.rand.random() < self.error_rate
+            if failed:
+                self.errors += 1
+        parsed = urlparse(url)
+        google = parsed.path.endswith("distancematrix/json")
+        if failed:
+            if google:
+                body = json.dumps({"rows": [], "status": "OVER_QUERY_LIMIT"})
+            else:
+                body = json.dumps({"bustime-response":
+                    {"error": [{"msg": "Transaction limit exceeded"}]}})
+            return BytesIO(body.encode("UTF8"))
+        if google:
+            body = self.distancematrix(**parse_qs(parsed.query))
+            return BytesIO(body.encode("UTF8"))
+        return super().urlopen(url)
 
+    def stop_id(self, route, direction, i):
+        return str(int(route) * 10000 + direction * 5000 + i)
 
+    def locate(self, route, direction, meters):
+        """lat/lon of a point meters out along a route's spoke. The two
+        directions run on either side of the street."""
+        angle = 2 * math.pi * int(route) / len(self.routes)
+        side = 8 if direction else -8
+        north = meters * math.cos(angle) - side * math.sin(angle)
+        east = meters * math.sin(angle) + side * math.cos(angle)
+        lat = self.CENTER[0] + north / 111195
+        lon = self.CENTER[1] + east / (111195 * math.cos(math.radians(self.CENTER[0])))
+        return lat, lon
 
+    def stop_list(self, route, direction):
+        stops = []
+        for i in range(self.stops):
+            lat, lon = self.locate(route, direction, 100 + 250 * i)
+            stops.append({"stpid": self.stop_id(route, direction, i),
+                "stpnm": "Route {0} stop {1}".format(route, i), "lat": lat, "lon": lon})
+        if direction == 0:
+            stops.reverse()
+        return stops
 
+    def pattern(self, route, direction):
+        per_stop = self.points // self.stops
+        stops = self.stop_list(route, direction)
+        pt = []
+        for (n, stop) in enumerate(stops):
+            i = int(stop["stpid"]) % 5000
+            meters = 250 * n
+            pt.append({"seq": len(pt) + 1, "typ": "S", "stpid": stop["stpid"],
+                "stpnm": stop["stpnm"], "pdist": round(meters * FEET_PER_METER),
+                "lat": stop["lat"], "lon": stop["lon"]})
+            for w in range(1, per_stop):
+                step = 250 * w / per_stop
+                lat, lon = self.locate(route, direction,
+                    100 + 250 * i + (step if direction else -step))
+                pt.append({"seq": len(pt) + 1, "typ": "W", "pdist": 0.0,
+                    "lat": lat, "lon": lon})
+        return {"pid": int(route) * 2 + direction, "ln": 250.0 * self.stops * FEET_PER_METER,
+            "rtdir": "INBOUND" if direction == 0 else "OUTBOUND", "pt": pt}
 
+    def route_vehicles(self, route):
+        vehicles = []
+        for v in range(self.vehicles):
+            direction = v % 2
+            along = 250 * (self.stops - 1) * (v + 0.5) / self.vehicles
+            if direction:
+                lat, lon = self.locate(route, direction, 100 + along)
+            else:
+                lat, lon = self.locate(route, direction, 100 + 250 * (self.stops - 1) - along)
+            vehicles.append({"vid": str(int(route) * 100 + v), "rt": route,
+                "pid": int(route) * 2 + direction, "pdist": round(along * FEET_PER_METER),
+                "tmstmp": "20141022 12:{0:02d}".format(v % 60), "lat": str(lat),
+                "lon": str(lon), "hdg": "90", "des": "Downtown", "dly": False,
+                "spd": 20, "tatripid": str(1000 + v), "tablockid": route + "-1", "zone": ""})
+        return vehicles
 
+    def _respond(self, errors=(), **resp):
+        if errors:
+            resp["error"] = list(errors)
+        return json.dumps({"bustime-response": resp})
 
+    def getroutes(self, **kwargs):
+        return self._respond(routes=[{"rt": r, "rtnm": "ROUTE " + r, "rtclr": "#cc00cc"}
+            for r in self.routes])
 
+    def getdirections(self, **kwargs):
+        return self._respond(directions=[{"dir": "INBOUND"}, {"dir": "OUTBOUND"}])
 
+    def getstops(self, **kwargs):
+        direction = 0 if kwargs["dir"][0] == "INBOUND" else 1
+        return self._respond(stops=self.stop_list(kwargs["rt"][0], direction))
 
+    def getpatterns(self, **kwargs):
+        if "pid" in kwargs:
+            pids = [int(p) for p in kwargs["pid"][0].split(",")]
+        else:
+            pids = [int(r) * 2 + d for r in kwargs["rt"][0].split(",") for d in (0, 1)]
+        return self._respond(ptr=[self.pattern(str(p // 2), p % 2) for p in pids])
+
+    def getpredictions(self, **kwargs):
+        prd = []
+        errors = []
+        for stpid in kwargs["stpid"][0].split(","):
+            if stpid in self.quiet:
+                errors.append({"stpid": stpid, "msg": "No service scheduled"})
+                continue
+            n = int(stpid)
+            route, direction = str(n // 10000), (n % 10000) // 5000
+            for k in range(n % 3 + 1):
+                minutes = (n + 7 * k) % 45
+                prd.append({"tmstmp": "20141022 12:00", "typ": "A",
+                    "stpnm": "Route {0} stop {1}".format(route, n % 5000), "stpid": stpid,
+                    "vid": str(int(route) * 100 + k), "dstp": 1000 * minutes,
+                    "rt": route, "rtdir": "INBOUND" if direction == 0 else "OUTBOUND",
+                    "des": "Downtown", "prdtm": "20141022 {0:02d}:{1:02d}".format(
+                        12 + minutes // 60, minutes % 60),
+                    "dly": False, "tablockid": route + "-1", "tatripid": str(1000 + k),
+                    "zone": "", "prdctdn": "DUE" if minutes < 2 else str(minutes)})
+        return self._respond(errors, prd=prd)
 
+    def getvehicles(self, **kwargs):
+        errors = []
+        if "vid" in kwargs:
+            wanted = kwargs["vid"][0].split(",")
+            routes = set(str(int(v) // 100) for v in wanted)
+            vehicles = [v for r in self.routes if r in routes
+                for v in self.route_vehicles(r) if v["vid"] in wanted]
+            found = set(v["vid"] for v in vehicles)
+            errors = [{"vid": v, "msg": "No data found for parameter"}
+                for v in wanted if v not in found]
+        else:
+            vehicles = []
+            for r in kwargs["rt"][0].split(","):
+                running = self.route_vehicles(r)
+                if not running:
+                    errors.append({"rt": r, "msg": "No data found for parameter"})
+                vehicles.extend(running)
+        return self._respond(errors, vehicle=vehicles)
 
+    def distancematrix(self, **kwargs):
+        lat, lon = [float(x) for x in kwargs["origins"][0].split(",")]
+        elements = []
+        for dest in kwargs["destinations"][0].split("|"):
+            dlat, dlon = [float(x) for x in dest.split(",")]
+            dy = (dlat - lat) * 111195
+            dx = (dlon - lon) * 111195 * math.cos(math.radians(lat))
+            meters = round(math.hypot(dx, dy) * 1.3)
+            elements.append({"distance": {"value": meters, "text": "{0} m".format(meters)},
+                "duration": {"value": round(meters / 1.4), "text": "mins"},
+                "status": "OK"})
+        return json.dumps({"rows": [{"elements": elements}], "status": "OK"})
@@ -0,0 +1,288 @@
+"""System-wide prediction snapshots.
+getpredictions takes at most ten stops a call, so covering every stop in a
+system takes hundreds of calls. SnapshotBuilder spreads them over a pool of
+threads or processes, and writes the results to one file that any number of
+local readers can memory-map and query with Snapshot, without calling the API.
+
+The file is a fixed header, then each stop's predictions as compact JSON,
+then a JSON index of where each stop's record is:
+
+    magic (8 bytes) | created (double) | index offset | index length (uint64)
+"""
+import json
+import mmap
+import os
+import struct
+import threading
+import time
+from . import _request_factory
+from .models import Prediction
+from .stops import batches, sort_predictions
+
+MAGIC = b"BUSSNAP1"
+_HEADER = struct.Struct("<8sdQQ")
+#fields every prediction at a stop repeats; stored once, in the index
+_STOP_FIELDS = ("stpid", "stpnm")
+
+
+def stop_directory(busapi, map=map):
+    """Every stop in the system, from getroutes, getdirections and getstops.
+    Returns a dict of stpid to (stpnm, [routes serving it]), and a dict of
+    route to its stpids. map is used for the per-route calls, so they can
+    be spread over a pool."""
+    routes = [r["rt"] for r in busapi.getroutes()]
+    def route_stops(route):
+        return [s for d in busapi.getdirections(route)
+            for s in busapi.getstops(route, d)]
+    stops = dict()
+    members = dict()
+    for (route, found) in zip(routes, map(route_stops, routes)):
+        ids = members.setdefault(route, [])
+        for s in found:
+            stpid = str(s["stpid"])
+            entry = stops.setdefault(stpid, (s["stpnm"], []))
+            if route not in entry[1]:
+                entry[1].append(route)
+                ids.append(stpid)
+    return stops, members
+
+
+def fetch_predictions(busapi, groups, top=10, stop=None):
+    """Predictions for each comma-joined batch of stop ids in groups.
+    Returns (found, failed, calls): found maps stpid to its predictions
+    (at most top), failed lists the stops BusTime reported an error for,
+    like those with no service scheduled. Once stop (an Event) is set,
+    the remaining batches are skipped."""
+    found = dict()
+    failed = []
+    calls = 0
+    for group in groups:
+        if stop is not None and stop.is_set():
+            break
+        ids = group.split(",")
+        part, errors = busapi.getbatch("getpredictions", "prd", "stpid", ids,
+            top=top * len(ids))
+        calls += 1
+        for (stpid, prds) in part.items():
+            found[stpid] = prds[:top]
+        failed.extend(errors)
+    return found, failed, calls
+
+
+_worker_api = None
+_worker_stop = None
+
+def _init_worker(apibase, key, factory, stop):
+    global _worker_api, _worker_stop
+    from . import BusTime
+    _worker_api = BusTime(apibase, key, factory=factory)
+    _worker_stop = stop
+
+def _worker_fetch(groups, top):
+    return fetch_predictions(_worker_api, groups, top, _worker_stop)
+
+
+class SnapshotBuilder:
+    """Writes snapshots of the predictions for every stop to path.
+    The stop ids are split into one shard per worker, and each worker
+    fetches its shard's batches in turn.
+
+    With processes set, workers are processes, and each makes its own
+    BusTime(busapi.apibase, busapi.key, factory=factory), so factory
+    must be picklable (a module-level function or class, or a partial
+    of one). Otherwise workers are threads sharing busapi.
+
+    Each snapshot is written to a temporary file and moved into place, so
+    readers always see a whole one. Stops BusTime reports an error for are
+    listed in the snapshot's failed; any other error fails the cycle, the
+    other workers stop after the batch they're on, and the last snapshot
+    is left alone."""
+    def __init__(self, busapi, path, *, workers=4, top=10, processes=False,
+            factory=_request_factory):
+        self.api = busapi
+        self.path = path
+        self.workers = workers
+        self.top = top
+        self.processes = processes
+        self.factory = factory
+        self.stops = None
+        self.routes = None
+        self.__threads = None
+        self.__pool = None
+        self.__stop = threading.Event()
+
+    def refresh_stops(self):
+        """(Re)fetch the stop directory. build() does this the first time."""
+        self.stops, self.routes = stop_directory(self.api, self.__threadpool().map)
+
+    def build(self):
+        """Fetch predictions for every stop and write a snapshot.
+        Returns a dict of stats for the cycle."""
+        start = time.perf_counter()
+        if self.stops is None:
+            self.refresh_stops()
+        groups = batches(sorted(self.stops))
+        shards = [groups[i::self.workers] for i in range(self.workers)]
+        pool = self.__processpool() if self.processes else self.__threadpool()
+        self.__stop.clear()
+        if self.processes:
+            futures = [pool.submit(_worker_fetch, s, self.top) for s in shards if s]
+        else:
+            futures = [pool.submit(fetch_predictions, self.api, s, self.top,
+                self.__stop) for s in shards if s]
+        from concurrent.futures import wait, FIRST_EXCEPTION
+        done, pending = wait(futures, return_when=FIRST_EXCEPTION)
+        if pending:
+            #a shard failed, so the cycle has; don't spend quota finishing it
+            self.__stop.set()
+            wait(pending)
+        found = dict()
+        failed = []
+        calls = 0
+        for f in futures:
+            part, bad, n = f.result()
+            found.update(part)
+            failed.extend(bad)
+            calls += n
+        write_snapshot(self.path, found, self.stops, self.routes, failed)
+        return {"stops": len(found), "failed": len(failed), "calls": calls,
+            "seconds": time.perf_counter() - start}
+
+    def run(self, interval=30, cycles=None, sleep=time.sleep):
+        """Build a snapshot every interval seconds, cycles times
+        (or forever). Yields each cycle's stats."""
+        n = 0
+        while cycles is None or n < cycles:
+            stats = self.build()
+            yield stats
+            n += 1
+            if cycles is None or n < cycles:
+                sleep(max(0, interval - stats["seconds"]))
+
+    def close(self):
+        """Shut down the workers."""
+        for pool in (self.__threads, self.__pool):
+            if pool is not None:
+                pool.shutdown()
+        self.__threads = self.__pool = None
+
+    def __threadpool(self):
+        if self.__threads is None:
+            from concurrent.futures import ThreadPoolExecutor
+            self.__threads = ThreadPoolExecutor(self.workers)
+        return self.__threads
+
+    def __processpool(self):
+        if self.__pool is None:
+            from concurrent.futures import ProcessPoolExecutor
+            from multiprocessing import Event
+            self.__stop = Event()
+            self.__pool = ProcessPoolExecutor(self.workers, initializer=_init_worker,
+                initargs=(self.api.apibase, self.api.key, self.factory, self.__stop))
+        return self.__pool
+
+
+def write_snapshot(path, predictions, stops, routes, failed=()):
+    """Write a snapshot file. predictions maps stpid to its predictions;
+    stops and routes are as returned by stop_directory."""
+    index = {"stops": dict(), "routes": routes, "failed": list(failed)}
+    tmp = "{0}.{1}.tmp".format(path, os.getpid())
+    try:
+        with open(tmp, "wb") as f:
+            f.write(bytes(_HEADER.size))
+            offset = _HEADER.size
+            for (stpid, prds) in predictions.items():
+                stpnm, served = stops.get(stpid, (None, []))
+                record = json.dumps([dict((k, v) for (k, v) in p.items()
+                    if k not in _STOP_FIELDS) for p in prds],
+                    separators=(",", ":")).encode("UTF8")
+                f.write(record)
+                index["stops"][stpid] = [offset, len(record), stpnm, served]
+                offset += len(record)
+            data = json.dumps(index, separators=(",", ":")).encode("UTF8")
+            f.write(data)
+            f.seek(0)
+            f.write(_HEADER.pack(MAGIC, time.time(), offset, len(data)))
+        os.replace(tmp, path)
+    except BaseException:
+        if os.path.exists(tmp):
+            os.remove(tmp)
+        raise
+
+
+class Snapshot:
+    """Read-only view of a snapshot file, memory-mapped so that readers in
+    different processes share one copy. Only the stops asked for are
+    decoded. If typed is set, predictions are models.Prediction records.
+
+    The file can be replaced while it's open; call reload() to switch to
+    the newest snapshot."""
+    def __init__(self, path, typed=False):
+        self.path = path
+        self.typed = typed
+        self.__map = None
+        self.reload()
+
+    def reload(self):
+        """Switch to the snapshot now at path. Returns whether it changed."""
+        with open(self.path, "rb") as f:
+            stat = os.fstat(f.fileno())
+            if self.__map is not None and (stat.st_ino, stat.st_mtime_ns) == self.__stat:
+                return False
+            mapped = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+        magic, created, offset, length = _HEADER.unpack_from(mapped)
+        if magic != MAGIC:
+            mapped.close()
+            raise ValueError("Not a snapshot: {0}".format(self.path))
+        index = json.loads(mapped[offset:offset + length].decode("UTF8"))
+        self.close()
+        self.__map = mapped
+        self.__stat = (stat.st_ino, stat.st_mtime_ns)
+        self.created = created
+        self.index = index["stops"]
+        self.routes = index["routes"]
+        self.failed = index["failed"]
+        return True
+
+    def __len__(self):
+        return len(self.index)
+
+    def __contains__(self, stpid):
+        return str(stpid) in self.index
+
+    def __iter__(self):
+        return iter(self.index)
+
+    def stop(self, stpid):
+        """The predictions for a stop, as BusTime ordered them. Raises KeyError for a
+        stop that isn't in the snapshot (see failed)."""
+        stpid = str(stpid)
+        offset, length, stpnm, served = self.index[stpid]
+        prds = json.loads(self.__map[offset:offset + length].decode("UTF8"))
+        for p in prds:
+            p["stpid"] = stpid
+            p["stpnm"] = stpnm
+        if self.typed:
+            return Prediction.from_dicts(prds)
+        return prds
+
+    def route(self, route):
+        """Predictions for route at all of its stops, sorted by arrival."""
+        found = [p for stpid in self.routes.get(route, ()) if stpid in self.index
+            for p in self.stop(stpid) if p["rt"] == route]
+        return sort_predictions(found)
+
+    def served_by(self, stpid):
+        """The routes that serve a stop."""
+        return list(self.index[str(stpid)][3])
+
+    def close(self):
+        if self.__map is not None:
+            self.__map.close()
+            self.__map = None
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        self.close()
@@ -0,0 +1,117 @@
+"""Spatial index over every stop in the system.
+Stops.stops_in_range works one route and direction at a time; StopIndex
+answers "which stops are near here, on any route" from a grid of cells."""
+import math
+from .distance import EARTH_RADIUS, haversine
+
+METERS_PER_DEGREE = EARTH_RADIUS * math.pi / 180
+
+
+class StopIndex:
+    """Grid index of stops, deduplicated by stpid.
+    Each stop remembers the (route, direction) pairs that serve it.
+    cell_size is the edge of a grid cell in meters (of latitude); queries
+    only look at the cells that overlap the search radius."""
+    def __init__(self, cell_size=250):
+        self.cell_size = cell_size
+        self._degrees = cell_size / METERS_PER_DEGREE
+        self.stops = dict()
+        self.members = dict()
+        self.routes = dict()
+        self._grid = dict()
+        self._cells = dict()
+
+    @classmethod
+    def from_api(cls, busapi, cell_size=250):
+        """Build an index from getstops, across every route and direction."""
+        index = cls(cell_size)
+        index.refresh(busapi)
+        return index
+
+    def refresh(self, busapi):
+        """Bring the index up to date with busapi.getroutes(). Only routes
+        that were added get fetched; routes that went away are dropped."""
+        current = set(r["rt"] for r in busapi.getroutes())
+        for route in set(self.routes) - current:
+            self.remove_route(route)
+        for route in sorted(current - set(self.routes)):
+            for direction in busapi.getdirections(route):
+                self.add_stops(route, direction, busapi.getstops(route, direction))
+
+    def add_stops(self, route, direction, stops):
+        """Index stops as served by route going in direction."""
+        served = self.routes.setdefault(route, dict()).setdefault(direction, set())
+        for stop in stops:
+            stpid = stop["stpid"]
+            if stpid not in self.stops:
+                self.stops[stpid] = stop
+                self.members[stpid] = set()
+                cell = self.__cell(float(stop["lat"]), float(stop["lon"]))
+                self._cells[stpid] = cell
+                self._grid.setdefault(cell, set()).add(stpid)
+            self.members[stpid].add((route, direction))
+            served.add(stpid)
+
+    def add_patterns(self, route, patterns):
+        """Index the stop points of getpatterns results for a route."""
+        for pattern in patterns:
+            stops = [p for p in pattern["pt"] if p["typ"] == "S"]
+            self.add_stops(route, pattern["rtdir"], stops)
+
+    def remove_route(self, route):
+        """Forget a route. Stops no other route serves are dropped."""
+        for direction, stpids in self.routes.pop(route, dict()).items():
+            for stpid in stpids:
+                members = self.members[stpid]
+                members.discard((route, direction))
+                if not members:
+                    self.__remove(stpid)
+
+    def within(self, location, radius):
+        """All stops within radius meters of location, nearest first.
+        Location must be a dict in the form {lat:40.1234, lon:80.1234}.
+        Returns a list of (meters, stop, memberships) 3-tuples, where
+        memberships is a set of (route, direction) pairs."""
+        lat, lon = float(location["lat"]), float(location["lon"])
+        dlat = radius / METERS_PER_DEGREE
+        edge = min(89.9, abs(lat) + dlat)
+        dlon = dlat / math.cos(math.radians(edge))
+        lo = self.__cell(lat - dlat, lon - dlon)
+        hi = self.__cell(lat + dlat, lon + dlon)
+        found = []
+        for i in range(lo[0], hi[0] + 1):
+            for j in range(lo[1], hi[1] + 1):
+                for stpid in self._grid.get((i, j), ()):
+                    stop = self.stops[stpid]
+                    meters = haversine(lat, lon, stop["lat"], stop["lon"])
+                    if meters <= radius:
+                        found.append((meters, stop, self.members[stpid]))
+        found.sort(key=lambda f: f[0])
+        return found
+
+    def nearest(self, location, count=1, max_radius=5000):
+        """The count nearest stops to location, within max_radius meters.
+        Same result form as within()."""
+        radius = self.cell_size
+        while True:
+            found = self.within(location, min(radius, max_radius))
+            if len(found) >= count or radius >= max_radius:
+                return found[:count]
+            radius *= 2
+
+    def __cell(self, lat, lon):
+        return (math.floor(lat / self._degrees), math.floor(lon / self._degrees))
+
+    def __remove(self, stpid):
+        del self.stops[stpid]
+        del self.members[stpid]
+        cell = self._cells.pop(stpid)
+        self._grid[cell].discard(stpid)
+        if not self._grid[cell]:
+            del self._grid[cell]
+
+    def __len__(self):
+        return len(self.stops)
+
+    def __contains__(self, stpid):
+        return stpid in self.stops
@@ -1,12 +1,22 @@
 """Convenience methods for working with stop data.
 Uses BusTime API and Distance API through dependency injection."""
+#getpredictions takes at most this many stop ids per call
+PREDICTION_BATCH = 10
+
 class Stops:
     """Manage stop data.
     Depends on a BusTime API object and a Distance API client.
+    Prediction batches are fetched concurrently, at most max_workers at a
+    time. If timeout is set and the batches for a query haven't all come
+    back within that many seconds, TimeoutError is raised, and batches
+    that haven't started yet are cancelled so they don't use up quota.
     """
-    def __init__(self, busapi, distanceapi):
+    def __init__(self, busapi, distanceapi, *, max_workers=4, timeout=None):
         self.api = busapi
         self.dist = distanceapi
+        self.max_workers = max_workers
+        self.timeout = timeout
+        self.__pool = None
 
     def stops_in_range(self, route, direction, location,
         distance=400, duration=None):
@@ -20,11 +30,7 @@ class Stops:
         """
         stops = self.api.getstops(route, direction)
         distances = self.dist.distance_points(location, *stops)
-        if duration:
-            distance_item = lambda x: x[1]["value"] <= duration
-        else:
-            distance_item = lambda x: x[0]["value"] <= distance
-        return [s[2] for s in distances if distance_item(s)]
+        return in_range(distances, distance, duration)
 
     def next_busses(self, route, direction, location, 
         distance=400, duration=None):
@@ -35,11 +41,56 @@ class Stops:
         predictions = self.__getpredics(ids, [route], direction)
         return predictions
 
+    def close(self):
+        """Shut down the worker threads, if any were started."""
+        if self.__pool is not None:
+            self.__pool.shutdown(wait=False)
+            self.__pool = None
+
     def __getpredics(self, ids, route, direction):
-        if len(ids) <= 10:
-            return self.api.getpredictions(",".join(ids),
-                route)
+        groups = batches(ids)
+        serial = len(groups) <= 1 or self.max_workers <= 1
+        if serial and self.timeout is None:
+            results = [self.api.getpredictions(b, route) for b in groups]
         else:
-            return self.api.getpredictions(",".join(ids[:10]),
-                route) + self.__getpredics(ids[10:], route, direction)
+            #with a timeout, even a lone batch goes through the pool, so
+            #there's something to stop waiting for
+            if self.__pool is None:
+                from concurrent.futures import ThreadPoolExecutor
+                self.__pool = ThreadPoolExecutor(max(1, self.max_workers))
+            from concurrent.futures import wait
+            futures = [self.__pool.submit(self.api.getpredictions, b, route)
+                for b in groups]
+            pending = wait(futures, self.timeout).not_done
+            if pending:
+                for f in pending:
+                    f.cancel()
+                raise TimeoutError("{0} of {1} prediction batches took over {2}s".format(
+                    len(pending), len(futures), self.timeout))
+            results = [f.result() for f in futures]
+        return sort_predictions(p for batch in results for p in batch)
+
+
+def in_range(distances, distance=400, duration=None):
+    """Filter distance_points results down to the stops in range."""
+    if duration:
+        distance_item = lambda x: x[1]["value"] <= duration
+    else:
+        distance_item = lambda x: x[0]["value"] <= distance
+    return [s[2] for s in distances if distance_item(s)]
+
+def batches(ids):
+    """Join stop ids into getpredictions-sized comma-separated batches."""
+    return [",".join(ids[i:i + PREDICTION_BATCH])
+        for i in range(0, len(ids), PREDICTION_BATCH)]
+
+def _countdown(prediction):
+    count = prediction.get("prdctdn", "")
+    if count == "DUE":
+        return 0
+    return int(count) if str(count).isdigit() else float("inf")
+
+def sort_predictions(predictions):
+    """Sort predictions by arrival: predicted time, then countdown."""
+    return sorted(predictions, key=lambda p: (p["prdtm"], _countdown(p)))
 
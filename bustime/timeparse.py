@@ -0,0 +1,44 @@
+"""Fast parsing for BusTime timestamps.
+BusTime only ever sends "YYYYMMDD HH:MM" or "YYYYMMDD HH:MM:SS", and a
+response full of predictions repeats the same few minutes over and over,
+so a fixed-format parser with a memo beats a general-purpose one."""
+from datetime import datetime, tzinfo
+from functools import lru_cache
+
+
+def parse_time(value, tz=None):
+    """Parse a BusTime timestamp into a datetime.
+    tz is a tzinfo or a zone name like "America/New_York" for the agency;
+    if it's None, the datetime is naive, in the agency's local time.
+    Strings in other formats go to dateutil, if it's installed."""
+    if tz is not None and not isinstance(tz, tzinfo):
+        tz = timezone(tz)
+    return _parse(value, tz)
+
+
+@lru_cache(maxsize=4096)
+def _parse(value, tz):
+    n = len(value)
+    if ((n == 14 or (n == 17 and value[14] == ":")) and value[8] == " "
+            and value[11] == ":" and value[:8].isdigit()):
+        try:
+            return datetime(int(value[0:4]), int(value[4:6]), int(value[6:8]),
+                int(value[9:11]), int(value[12:14]),
+                int(value[15:17]) if n == 17 else 0, tzinfo=tz)
+        except ValueError:
+            pass
+    try:
+        import dateutil.parser
+    except ImportError:
+        raise ValueError("Unrecognized BusTime timestamp: {0!r}".format(value))
+    dt = dateutil.parser.parse(value)
+    if tz is not None and dt.tzinfo is None:
+        dt = dt.replace(tzinfo=tz)
+    return dt
+
+
+@lru_cache(maxsize=None)
+def timezone(name):
+    """The tzinfo for a zone name."""
+    from zoneinfo import ZoneInfo
+    return ZoneInfo(name)
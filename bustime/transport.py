@@ -0,0 +1,176 @@
+"""Pooled keep-alive transport for the BusTime API.
+Anything with a urlopen(url) method returning a readable response can be
+handed to BusTime through its factory= hook; this one keeps a bounded set of
+persistent connections per host instead of opening one per call."""
+import http.client
+import threading
+import time
+from urllib.error import HTTPError
+from urllib.parse import urlsplit
+
+#errors that mean a pooled socket was closed under us by the server
+_STALE = (ConnectionError, http.client.BadStatusLine)
+
+
+def _connect(scheme, host, port, timeout):
+    """Default connection factory, backed by http.client."""
+    if scheme == "https":
+        return http.client.HTTPSConnection(host, port, timeout=timeout)
+    return http.client.HTTPConnection(host, port, timeout=timeout)
+
+
+class PooledRequest:
+    """Drop-in replacement for urllib.request that reuses connections.
+    Use it as BusTime(base, key, factory=PooledRequest), or wrap it in
+    functools.partial to configure it.
+
+    pool_size bounds the number of open connections per host, idle
+    connections older than idle_timeout seconds are discarded, and a
+    request that fails on a reused (stale) socket is retried up to
+    retries times on a fresh one.
+
+    connection_factory(scheme, host, port, timeout) must return an object
+    with the http.client.HTTPConnection request/getresponse/close interface;
+    see MockRequest.connection for an in-process one.
+    connections_opened counts every connection created, for benchmarking.
+
+    A request waits at most acquire_timeout seconds for a free connection
+    to its host before raising TimeoutError."""
+    def __init__(self, pool_size=4, idle_timeout=30.0, retries=1, timeout=10.0,
+            connection_factory=_connect, acquire_timeout=60.0):
+        self.pool_size = pool_size
+        self.idle_timeout = idle_timeout
+        self.retries = retries
+        self.timeout = timeout
+        self.acquire_timeout = acquire_timeout
+        self.connection_factory = connection_factory
+        self.connections_opened = 0
+        self._lock = threading.Lock()
+        self._idle = dict()
+        self._slots = dict()
+
+    def urlopen(self, url):
+        """Issue a GET for url. Returns a response with read() and close();
+        the connection goes back to the pool once the body is consumed."""
+        parts = urlsplit(url)
+        key = (parts.scheme, parts.hostname, parts.port)
+        path = parts.path or "/"
+        if parts.query:
+            path += "?" + parts.query
+        slot = self.__slot(key)
+        if not slot.acquire(timeout=self.acquire_timeout):
+            raise TimeoutError("No free connection to {0}".format(parts.netloc))
+        try:
+            attempt = 0
+            while True:
+                conn, reused = self.__checkout(key)
+                try:
+                    conn.request("GET", path, headers={"Connection": "keep-alive"})
+                    resp = conn.getresponse()
+                except _STALE:
+                    conn.close()
+                    if not reused or attempt >= self.retries:
+                        raise
+                    attempt += 1
+                    continue
+                except Exception:
+                    conn.close()
+                    raise
+                break
+            if resp.status >= 400:
+                conn.close()
+                raise HTTPError(url, resp.status, resp.reason, resp.msg, resp)
+        except Exception:
+            slot.release()
+            raise
+        return _PooledResponse(self, key, conn, resp, slot)
+
+    def close(self):
+        """Close every idle connection."""
+        with self._lock:
+            idle, self._idle = self._idle, dict()
+        for conns in idle.values():
+            for conn, _ in conns:
+                conn.close()
+
+    def __slot(self, key):
+        with self._lock:
+            if key not in self._slots:
+                self._slots[key] = threading.BoundedSemaphore(self.pool_size)
+            return self._slots[key]
+
+    def __checkout(self, key):
+        """Get an idle connection for key, or open a new one.
+        Returns (connection, reused)."""
+        now = time.monotonic()
+        expired = []
+        conn = None
+        with self._lock:
+            conns = self._idle.get(key, [])
+            while conns:
+                candidate, used = conns.pop()
+                if now - used > self.idle_timeout:
+                    expired.append(candidate)
+                else:
+                    conn = candidate
+                    break
+            if conn is None:
+                self.connections_opened += 1
+        for c in expired:
+            c.close()
+        if conn is not None:
+            return conn, True
+        scheme, host, port = key
+        return self.connection_factory(scheme, host, port, self.timeout), False
+
+    def _checkin(self, key, conn):
+        with self._lock:
+            conns = self._idle.setdefault(key, [])
+            if len(conns) < self.pool_size:
+                conns.append((conn, time.monotonic()))
+                return
+        conn.close()
+
+
+class _PooledResponse:
+    """Wraps an HTTPResponse, returning its connection to the pool when the
+    body has been fully read, or discarding it if closed early."""
+    def __init__(self, pool, key, conn, resp, slot):
+        self.pool = pool
+        self.key = key
+        self.conn = conn
+        self.resp = resp
+        self.status = resp.status
+        self.headers = resp.msg
+        self.__slot = slot
+
+    def read(self, amt=None):
+        if self.conn is None:
+            return b""
+        try:
+            data = self.resp.read(amt)
+        except Exception:
+            #a body that fails part way leaves the connection unusable
+            self.__release(keep=False)
+            raise
+        if self.resp.isclosed():
+            self.__release(keep=not self.resp.will_close)
+        return data
+
+    def close(self):
+        if self.conn is not None:
+            self.__release(keep=False)
+
+    def __release(self, keep):
+        conn, self.conn = self.conn, None
+        if keep:
+            self.pool._checkin(self.key, conn)
+        else:
+            conn.close()
+        self.__slot.release()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        self.close()
@@ -0,0 +1,98 @@
+"""Track vehicle positions over time, as a stream of changes.
+Polls getvehicles and yields only what changed since the last poll."""
+import time
+from collections import namedtuple
+from .distance import haversine
+from .models import Vehicle
+
+#getvehicles takes at most this many routes per call
+MAX_ROUTES = 10
+
+VehicleDelta = namedtuple("VehicleDelta", ["added", "moved", "removed"])
+
+
+class VehicleTracker:
+    """In-memory table of vehicles, keyed on vid.
+    update() takes a full getvehicles result and returns a VehicleDelta of
+    the vehicles that appeared, moved at least threshold meters from where
+    they were last reported, or disappeared. Records whose tmstmp hasn't
+    changed are skipped without looking at their position.
+
+    The tracker also adapts the poll interval: it shrinks toward
+    min_interval while the data keeps changing, and grows toward
+    max_interval while it doesn't."""
+    def __init__(self, threshold=25, interval=10, min_interval=None,
+            max_interval=None):
+        self.threshold = threshold
+        self.interval = interval
+        self.min_interval = interval / 2 if min_interval is None else min_interval
+        self.max_interval = interval * 4 if max_interval is None else max_interval
+        self.vehicles = dict()
+        self._stamps = dict()
+
+    def update(self, vehicles):
+        added, moved = [], []
+        stamps = dict()
+        changed = False
+        for v in vehicles:
+            vid = v["vid"]
+            stamps[vid] = v["tmstmp"]
+            if self._stamps.get(vid) == v["tmstmp"]:
+                continue
+            changed = True
+            old = self.vehicles.get(vid)
+            if old is None:
+                added.append(v)
+                self.vehicles[vid] = v
+            elif haversine(old["lat"], old["lon"], v["lat"], v["lon"]) >= self.threshold:
+                moved.append(v)
+                self.vehicles[vid] = v
+        removed = [self.vehicles.pop(vid) for vid in list(self.vehicles)
+            if vid not in stamps]
+        self._stamps = stamps
+        self.__adapt(changed or bool(removed))
+        return VehicleDelta(added, moved, removed)
+
+    def __adapt(self, changed):
+        if changed:
+            self.interval = max(self.min_interval, self.interval / 1.5)
+        else:
+            self.interval = min(self.max_interval, self.interval * 1.5)
+
+
+def route_groups(routes):
+    """Split routes into getvehicles-sized groups."""
+    routes = list(routes)
+    return [routes[i:i + MAX_ROUTES] for i in range(0, len(routes), MAX_ROUTES)]
+
+
+def group_vehicles(busapi, group):
+    """getvehicles for a group of routes, via BusTime.getbatch. A route
+    with no vehicles out (at the end of service, say) gets an error entry
+    instead of an empty list; getbatch keeps it from failing the call.
+    For an AsyncBusTime, this returns a coroutine; pass what it returns
+    (or its result) to vehicle_list."""
+    return busapi.getbatch("getvehicles", "vehicle", "rt", group, Vehicle,
+        resolution="S")
+
+
+def vehicle_list(batch):
+    """The vehicles from a group_vehicles result, as one list."""
+    found, errors = batch
+    return [v for vs in found.values() for v in vs]
+
+
+def stream_vehicles(busapi, routes, interval=10, *, threshold=25,
+        min_interval=None, max_interval=None, sleep=time.sleep):
+    """Poll getvehicles for routes forever, yielding a VehicleDelta whenever
+    something changed. The first delta has every vehicle as added, and
+    a route that stops running has all its vehicles removed.
+    See VehicleTracker for the threshold and interval arguments."""
+    tracker = VehicleTracker(threshold, interval, min_interval, max_interval)
+    groups = route_groups(routes)
+    while True:
+        vehicles = [v for g in groups for v in vehicle_list(group_vehicles(busapi, g))]
+        delta = tracker.update(vehicles)
+        if any(delta):
+            yield delta
+        sleep(tracker.interval)